@@ -0,0 +1,42 @@
+import os
+from argparse import ArgumentParser
+
+import pandas as pd
+
+from dataloading import ClipPyramid, build_video_cache
+
+
+def parse_args():
+    parser = ArgumentParser()
+    parser.add_argument('--datasets_dir', type=str, default='/home/huze/algonauts_datasets/')
+    parser.add_argument('--video_size', type=int, default=288)
+    parser.add_argument('--video_frames', type=int, default=16)
+    parser.add_argument('--preprocessing_type', type=str, default='mmit', help='mmit, bdcn, bit, raw (uint8 frames for --compact_cache)')
+    parser.add_argument('--pyramid', type=str, default='',
+                        help='{resolution}_{frames} pyramid master, e.g. 288_64; decodes it once and derives '
+                             '--video_size / --video_frames from it')
+    parser.add_argument('--pyramid_budget_gb', type=float, default=100.)
+    parser.add_argument('--num_workers', type=int, default=8)
+    args = parser.parse_args()
+    return args
+
+
+def main(args):
+    # full_vid.csv lists train + test clips, the train csvs are a subset
+    vid_file_list = pd.read_csv(os.path.join(args.datasets_dir, 'full_vid.csv'))['vid'].values
+    if args.pyramid:
+        pyramid = ClipPyramid(args.datasets_dir, [int(v) for v in args.pyramid.split('_')],
+                              budget_gb=args.pyramid_budget_gb)
+        print('master ready ...', pyramid.build_master(vid_file_list, num_workers=args.num_workers))
+        print('cache ready ...', pyramid.variant(args.video_frames, args.video_size, args.preprocessing_type))
+        return
+    cached_dir = build_video_cache(args.datasets_dir, vid_file_list,
+                                   num_frames=args.video_frames,
+                                   resolution=args.video_size,
+                                   preprocessing_type=args.preprocessing_type,
+                                   num_workers=args.num_workers)
+    print('cache ready ...', cached_dir)
+
+
+if __name__ == '__main__':
+    main(parse_args())
@@ -28,6 +28,9 @@ from main import LitModel
 from bdcn import load_bdcn
 from model_i3d import *
 from i3d_flow import *
+from saliency import ChunkedInputGrads, SaliencySummarizer
+from column_store import ColumnStore
+from job_queue import JobQueue, default_worker_name
 
 import numpy as np
 
@@ -49,6 +52,10 @@ def parse_args():
     parser.add_argument('--end', type=int, default=1102)
     parser.add_argument('--save_dir', type=str, default='/data_60/huze/algonauts_grad_data/')
     parser.add_argument('--ckpt_dir', type=str, default='/data_smr/huze/projects/my_algonauts/checkpoints_mmit_ft/')
+    parser.add_argument('--chunk_size', type=int, default=64, help='voxels per batched backward, halves on OOM')
+    parser.add_argument('--output', type=str, default='columnar', help='columnar (one ColumnStore) or npy (per video)')
+    parser.add_argument('--queue', type=str, default='',
+                        help='sqlite job queue shared by all workers, --start/--end videos are added to it')
 
     args = parser.parse_args()
     return args
@@ -148,17 +155,21 @@ num_voxels = len(voxel_config[roi])
 if args.reverse:
     idxs = idxs[::-1]
 
-for idx in idxs:
-    save_path_tmax = os.path.join(save_dir, f'video{idx}-tmax.npy')
+saliency = ChunkedInputGrads(args.chunk_size)
+summarizer = SaliencySummarizer('tmax', resolution=resolution, mean=mean, std=std)
+store = ColumnStore(os.path.join(save_dir, 'saliency')) if args.output == 'columnar' else None
+
+def run_video(idx):
+    key = f'video{idx}'
+    save_path_tmax = os.path.join(save_dir, f'{key}-tmax.npy')
     # save_path_full = os.path.join(save_dir, f'video{idx}-full.npy')
 
     # if os.path.exists(save_path_tmax) and os.path.exists(save_path_full):
-    if os.path.exists(save_path_tmax):
-        print('skipping ...', save_path_tmax)
-        continue
-    print('saving to ...', save_path_tmax)
-    
-    grads = torch.zeros((num_voxels, resolution, resolution), dtype=torch.float32)
+    if (key in store) if store is not None else os.path.exists(save_path_tmax):
+        print('skipping ...', key)
+        return
+    print('saving ...', key)
+
     # full_grads = torch.zeros((num_voxels, hparams['video_frames'], resolution, resolution), dtype=torch.float32)
 
     vid = data_loader.dataset.__getitem__(idx)
@@ -166,38 +177,33 @@ for idx in idxs:
     vid.requires_grad = True
     out = plmodel({'video': vid})
     out = out[0]['WB'][0]
-    
-    for i_voxel in tqdm(range(num_voxels)):
-#         with timeit('backward'):
-        loss = out[voxel_config[roi][i_voxel]] * 1e5
-        loss.backward(retain_graph=True)
-
-        grad = vid.grad.detach().clone()
-        vid.grad = None
-
-        # downsample
-        grad = F.interpolate(grad, size=(
-            grad.shape[-3], resolution, resolution))
-        
-        grad = grad[0]
-        grad = grad.permute(1, 2, 3, 0)
-        grad = grad * std + mean
-        grad = grad.mean(-1) # grey
-#         grad = reject_outliers_torch(grad, m=3)
-        grad = grad.cpu()
-    
-        grads[i_voxel] = grad.max(0)[0] # max-pooling
-        # full_grads[i_voxel] = grad
-
-#         if i_voxel == 10:
-#             break
-
-    with open(save_path_tmax, 'wb') as f:
-        np.save(f, grads.numpy())
+
+    summary = saliency(out, vid, voxel_config[roi][:num_voxels], post=summarizer)
+    if store is not None:
+        store.append(key, summarizer.to_columns(summary))
+    else:
+        atomic_save_npy(save_path_tmax, summary['tmax'].cpu().numpy())
     # with open(save_path_full, 'wb') as f:
     #     np.save(f, full_grads.numpy())
 
 
+if args.queue:
+    queue = JobQueue(args.queue)
+    queue.add(task_id, roi, idxs)
+    for job in queue.jobs(default_worker_name(DEVICE), task_id, roi, reverse=args.reverse):
+        try:
+            run_video(job.video)
+        except Exception as e:
+            print('failed ...', job, e)
+            queue.fail(job, repr(e))
+            continue
+        queue.complete(job)
+    print(queue.counts(task_id, roi))
+else:
+    for idx in idxs:
+        run_video(idx)
+
+
 # In[ ]:
 
 
@@ -0,0 +1,92 @@
+import os
+import json
+
+import numpy as np
+from tqdm import tqdm
+
+from utils import atomic_save_json, file_lock
+
+STORE_FILE = 'clips_store.npy'
+INDEX_FILE = 'clips_store.json'
+
+
+def clip_store_exists(store_dir):
+    return os.path.exists(os.path.join(store_dir, STORE_FILE)) and \
+           os.path.exists(os.path.join(store_dir, INDEX_FILE))
+
+
+def build_clip_store(store_dir, np_paths, dtype=None):
+    """consolidate one-npy-per-clip files into a single contiguous [N, C, T, H, W] npy plus a name index
+
+    Written to a temp file and renamed, under a lock on store_dir, so concurrent jobs build it once.
+    """
+    os.makedirs(store_dir, exist_ok=True)
+    store_path = os.path.join(store_dir, STORE_FILE)
+    index_path = os.path.join(store_dir, INDEX_FILE)
+    with file_lock(os.path.join(store_dir, '.store_lock')):
+        if clip_store_exists(store_dir):
+            return store_dir
+
+        first = np.load(np_paths[0], mmap_mode='r')
+        dtype = first.dtype if dtype is None else np.dtype(dtype)
+        tmp_path = f'{store_path}.tmp{os.getpid()}.npy'
+        store = np.lib.format.open_memmap(tmp_path, mode='w+', dtype=dtype, shape=(len(np_paths), *first.shape))
+        for i, path in enumerate(tqdm(np_paths, desc=f'consolidating {store_dir}')):
+            store[i] = np.load(path)
+        store.flush()
+        del store
+        os.replace(tmp_path, store_path)
+
+        index = {os.path.basename(path): i for i, path in enumerate(np_paths)}
+        atomic_save_json(index_path, {'shape': [len(np_paths), *first.shape], 'dtype': dtype.str, 'index': index})
+    return store_dir
+
+
+class ClipStore(object):
+    """read-only view of a consolidated clip store, indexed by clip file name
+
+    The memmap is opened lazily so every DataLoader worker maps the same file and shares one page cache.
+    Mode 'c' (copy-on-write) keeps the returned slices writable for torch without copying them.
+    """
+
+    def __init__(self, store_dir, names):
+        self.store_dir = store_dir
+        with open(os.path.join(store_dir, INDEX_FILE)) as f:
+            meta = json.load(f)
+        missing = [name for name in names if name not in meta['index']]
+        if missing:
+            raise KeyError(f'{len(missing)} clips missing from {store_dir}, e.g. {missing[0]}')
+        self.rows = np.array([meta['index'][name] for name in names])
+        self.shape = (len(names), *meta['shape'][1:])
+        self.dtype = np.dtype(meta['dtype'])
+        self._clips = None
+
+    @property
+    def clips(self):
+        if self._clips is None:
+            self._clips = np.load(os.path.join(self.store_dir, STORE_FILE), mmap_mode='c')
+        return self._clips
+
+    def __len__(self):
+        return len(self.rows)
+
+    def __getitem__(self, index):
+        return self.clips[self.rows[index]]
+
+    def __getstate__(self):
+        # don't pickle the mapping into worker processes, each one re-opens it
+        state = self.__dict__.copy()
+        state['_clips'] = None
+        return state
+
+
+def frame_index(frame_idxs):
+    """evenly spaced frame indices as a slice (strided view), anything else stays a fancy index"""
+    frame_idxs = np.asarray(frame_idxs)
+    if len(frame_idxs) > 1:
+        steps = np.diff(frame_idxs)
+        if steps[0] > 0 and np.all(steps == steps[0]):
+            return slice(int(frame_idxs[0]), int(frame_idxs[-1]) + 1, int(steps[0]))
+    elif len(frame_idxs) == 1:
+        return slice(int(frame_idxs[0]), int(frame_idxs[0]) + 1)
+    return frame_idxs
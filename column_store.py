@@ -0,0 +1,92 @@
+import os
+import json
+
+import numpy as np
+
+from utils import atomic_save_json, file_lock
+
+SCHEMA_FILE = 'schema.json'
+
+
+class ColumnStore(object):
+    """appendable columnar store: one raw .bin file per column plus schema.json (dtypes, row shapes, segments)
+
+    Every append adds the rows of one segment (e.g. all voxels of one video) to every column.
+    Appends hold a lock on the directory, so several processes can fill the same store, and the schema
+    is only updated after the data is on disk: a crashed append is truncated away on the next one.
+    """
+
+    def __init__(self, store_dir):
+        self.store_dir = store_dir
+        os.makedirs(store_dir, exist_ok=True)
+        self.schema = self.read_schema()
+
+    def read_schema(self):
+        path = os.path.join(self.store_dir, SCHEMA_FILE)
+        if not os.path.exists(path):
+            return {'rows': 0, 'columns': {}, 'segments': {}}
+        with open(path) as f:
+            return json.load(f)
+
+    def column_path(self, name):
+        return os.path.join(self.store_dir, f'{name}.bin')
+
+    def __contains__(self, key):
+        return key in self.read_schema()['segments']
+
+    def append(self, key, columns):
+        columns = {k: np.ascontiguousarray(v) for k, v in columns.items()}
+        num_rows = len(next(iter(columns.values())))
+        assert all(len(v) == num_rows for v in columns.values())
+
+        with file_lock(os.path.join(self.store_dir, '.lock')):
+            schema = self.read_schema()
+            if key in schema['segments']:
+                return False
+            if not schema['columns']:
+                schema['columns'] = {k: {'dtype': v.dtype.str, 'shape': list(v.shape[1:])} for k, v in columns.items()}
+            assert set(columns) == set(schema['columns']), f'columns {sorted(columns)} != {sorted(schema["columns"])}'
+
+            start = schema['rows']
+            for name, meta in schema['columns'].items():
+                values = columns[name].astype(meta['dtype'], copy=False)
+                assert list(values.shape[1:]) == meta['shape'], name
+                row_bytes = values.dtype.itemsize * int(np.prod(meta['shape']))
+                with open(self.column_path(name), 'ab') as f:
+                    f.truncate(start * row_bytes)  # drop the tail of a crashed append
+                    f.write(values.tobytes())
+                    f.flush()
+                    os.fsync(f.fileno())
+
+            schema['rows'] = start + num_rows
+            schema['segments'][key] = [start, start + num_rows]
+            atomic_save_json(os.path.join(self.store_dir, SCHEMA_FILE), schema)
+            self.schema = schema
+        return True
+
+
+class ColumnReader(object):
+    """memmapped read access to a ColumnStore"""
+
+    def __init__(self, store_dir):
+        self.store_dir = store_dir
+        with open(os.path.join(store_dir, SCHEMA_FILE)) as f:
+            self.schema = json.load(f)
+        self._columns = {}
+
+    def keys(self):
+        return self.schema['segments'].keys()
+
+    def column(self, name):
+        if name not in self._columns:
+            meta = self.schema['columns'][name]
+            if self.schema['rows'] == 0:
+                return np.empty((0, *meta['shape']), dtype=meta['dtype'])
+            self._columns[name] = np.memmap(os.path.join(self.store_dir, f'{name}.bin'), dtype=meta['dtype'],
+                                            mode='r', shape=(self.schema['rows'], *meta['shape']))
+        return self._columns[name]
+
+    def __getitem__(self, key):
+        """every column of one segment"""
+        start, end = self.schema['segments'][key]
+        return {name: self.column(name)[start:end] for name in self.schema['columns']}
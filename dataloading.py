@@ -1,6 +1,12 @@
 import os
+import json
+import time
+import fcntl
 import types
+import shutil
 import collections
+from functools import partial
+from multiprocessing import Pool
 import numpy as np
 from random import shuffle
 import torch
@@ -13,7 +19,8 @@ from torch._utils import _accumulate
 from torchvision import transforms
 from torch import nn
 from tqdm import tqdm
-from torch.utils.data import Dataset, random_split, DataLoader, Subset
+from torch.utils.data import Dataset, random_split, DataLoader, Subset, BatchSampler, RandomSampler, \
+    SequentialSampler, Sampler
 from torchvision.datasets import MNIST
 from sklearn.model_selection import KFold
 
@@ -23,17 +30,17 @@ import decord
 from decord import VideoReader, cpu, gpu
 
 # decord.bridge.set_bridge('torch')
-from utils import concat_and_mask
+from clip_store import ClipStore, build_clip_store, clip_store_exists, frame_index, STORE_FILE as CLIPS_FILE, \
+    INDEX_FILE as CLIPS_INDEX_FILE
+from feature_cache import FeatureStore
+from fmri_store import FMRIStore, TRACKS, fmri_store_dir, fmri_store_exists
+from utils import concat_and_mask, atomic_save_npy, atomic_save_json, is_valid_npy, file_lock
 
 
 def load_video(file, num_frames, load_transform):
     vr = VideoReader(file, ctx=cpu(0))
     total_frames = len(vr)
     indices = np.linspace(0, total_frames - 1, num_frames, dtype=np.int)
-    # vid = vr.get_batch(indices)
-    # vid = vid.moveaxis(-1, 1)
-    # vid = load_transform(vid / 255)
-    # vid = vid.moveaxis(0, 1)
     images = []
     for seg_ind in indices:
         images.append(load_transform(Image.fromarray(vr[seg_ind].asnumpy())))
@@ -42,6 +49,51 @@ def load_video(file, num_frames, load_transform):
     return vid
 
 
+# mean, std, rgb2bgr, x255 -- same numbers as the torchvision pipelines in wrap_load_one_video
+PREPROCESSING_STATS = {
+    'mmit': ([0.485, 0.456, 0.406], [0.229, 0.224, 0.225], False, False),
+    'bdcn': ([0.4810938, 0.45752459, 0.40787055], [1, 1, 1], True, True),
+    'bit': ([0.5, 0.5, 0.5], [0.5, 0.5, 0.5], False, False),
+}
+
+
+def load_video_batched(file, num_frames, resolution, preprocessing_type='mmit'):
+    """decode all sampled frames with one decord call, resize & normalize the whole clip at once
+
+    returns C x T x H x W float tensor, same layout as load_video
+    preprocessing_type 'raw' skips normalization and returns the resized frames as uint8
+    """
+    vr = VideoReader(file, ctx=cpu(0))
+    total_frames = len(vr)
+    indices = np.linspace(0, total_frames - 1, num_frames, dtype=np.int)
+    vid = torch.from_numpy(vr.get_batch(indices).asnumpy())  # T x H x W x C, uint8
+    vid = vid.permute(0, 3, 1, 2).float() / 255
+    vid = K.geometry.transform.resize(vid, (resolution, resolution), interpolation='bilinear', antialias=True)
+    if preprocessing_type == 'raw':
+        vid = (vid * 255).round().clamp(0, 255).to(torch.uint8)
+    else:
+        vid = normalize_video(vid, preprocessing_type, channel_dim=1)
+    vid = vid.moveaxis(0, 1)
+    return vid
+
+
+def normalize_video(vid, preprocessing_type, channel_dim=0):
+    """(x - mean) / std [-> BGR] [-> *255] along channel_dim, for x in [0, 1]"""
+    if preprocessing_type not in PREPROCESSING_STATS:
+        raise NotImplementedError(preprocessing_type)
+    mean, std, rgb2bgr, x255 = PREPROCESSING_STATS[preprocessing_type]
+    shape = [1] * vid.dim()
+    shape[channel_dim] = -1
+    mean = torch.tensor(mean, dtype=vid.dtype, device=vid.device).reshape(shape)
+    std = torch.tensor(std, dtype=vid.dtype, device=vid.device).reshape(shape)
+    vid = (vid - mean) / std
+    if rgb2bgr:
+        vid = torch.flip(vid, [channel_dim])
+    if x255:
+        vid = vid * 255
+    return vid
+
+
 class RGB2BGR(torch.nn.Module):
     def forward(self, tensor):
         return torch.flip(tensor, [0])
@@ -58,40 +110,29 @@ class TwoFiveFive(torch.nn.Module):
         return self.__class__.__name__
 
 
-def wrap_load_videos(root, file_lists, num_frames=16, resolution=288, preprocessing_type='mmit'):
-    # load all to memory
+def _init_decode_worker():
+    # one intra-op thread per process, the pool already saturates the cores
+    torch.set_num_threads(1)
 
-    # t = nn.Sequential(
-    #     K.augmentation.Normalize([0.485, 0.456, 0.406],
-    #                              [0.229, 0.224, 0.225]),
-    #
-    # )
-    if preprocessing_type == 'mmit':
-        resize_normalize = transforms.Compose([
-            transforms.Resize((resolution, resolution)),
-            transforms.ToTensor(),
-            transforms.Normalize([0.485, 0.456, 0.406], [0.229, 0.224, 0.225]),
-        ])
-    elif preprocessing_type == 'bdcn':
-        resize_normalize = transforms.Compose([
-            transforms.Resize((resolution, resolution)),
-            transforms.ToTensor(),
-            transforms.Normalize([0.4810938, 0.45752459, 0.40787055], [1, 1, 1]),
-            RGB2BGR(),
-            TwoFiveFive(),
-        ])
-    else:
-        NotImplementedError()
 
-    vids = []
-    for file in file_lists:
-        vid = load_video(os.path.join(root, file), num_frames, resize_normalize)
-        vids.append(vid)
+def wrap_load_videos(root, file_lists, num_frames=16, resolution=288, preprocessing_type='mmit',
+                     batched=True, num_workers=8):
+    # load all to memory, one decode job per file
+    load_fn = partial(wrap_load_one_video, root, num_frames=num_frames, resolution=resolution,
+                      preprocessing_type=preprocessing_type, batched=batched)
+    if num_workers > 1:
+        with Pool(num_workers, initializer=_init_decode_worker) as pool:
+            vids = pool.map(load_fn, file_lists)
+    else:
+        vids = [load_fn(file) for file in file_lists]
     vids = torch.stack(vids, 0)
     return vids
 
 
-def wrap_load_one_video(root, file, num_frames=16, resolution=288, preprocessing_type='mmit'):
+def wrap_load_one_video(root, file, num_frames=16, resolution=288, preprocessing_type='mmit', batched=True):
+    if batched:
+        return load_video_batched(os.path.join(root, file), num_frames, resolution, preprocessing_type)
+
     if preprocessing_type == 'mmit':
         resize_normalize = transforms.Compose([
             transforms.Resize((resolution, resolution)),
@@ -119,6 +160,216 @@ def wrap_load_one_video(root, file, num_frames=16, resolution=288, preprocessing
     return vid
 
 
+# resize of the clips build_video_cache writes (load_video_batched), recorded in the cache manifest
+VIDEO_CACHE_RESIZE = 'kornia_bilinear_antialias'
+
+
+def video_cache_dir(dataset_dir, resolution, num_frames, preprocessing_type):
+    return os.path.join(dataset_dir, f'{resolution}_{num_frames}_{preprocessing_type}_npy')
+
+
+def video_cache_name(file):
+    return os.path.basename(file).replace('.mp4', '.npy')
+
+
+def _cache_one_video(job):
+    root, file, path, num_frames, resolution, preprocessing_type = job
+    vid = wrap_load_one_video(root, file, num_frames=num_frames, resolution=resolution,
+                              preprocessing_type=preprocessing_type)
+    atomic_save_npy(path, vid.numpy())
+    return file, list(vid.shape)
+
+
+def build_video_cache(dataset_dir, vid_file_list, num_frames=16, resolution=288, preprocessing_type='mmit',
+                      num_workers=8):
+    """decode every missing clip of vid_file_list into the {resolution}_{num_frames}_{type}_npy cache
+
+    Idempotent and resumable: finished clips are recorded in manifest.json, files are written atomically,
+    and the whole build holds a lock on the cache dir, so concurrent jobs on a fresh resolution wait for
+    the first one instead of decoding the same videos again. A partial cache of the old per-frame PIL
+    resize is not resumed, the two resizes differ slightly.
+    """
+    cached_dir = video_cache_dir(dataset_dir, resolution, num_frames, preprocessing_type)
+    os.makedirs(cached_dir, exist_ok=True)
+    manifest_path = os.path.join(cached_dir, 'manifest.json')
+    vid_root = os.path.join(dataset_dir, 'videos')
+
+    with file_lock(os.path.join(cached_dir, '.lock')):
+        if os.path.exists(manifest_path):
+            with open(manifest_path) as f:
+                manifest = json.load(f)
+            manifest.setdefault('resize', VIDEO_CACHE_RESIZE)  # manifests came with the batched decode
+        else:
+            manifest = {'num_frames': num_frames, 'resolution': resolution,
+                        'preprocessing_type': preprocessing_type, 'resize': VIDEO_CACHE_RESIZE, 'done': {}}
+        no_manifest = not os.path.exists(manifest_path)
+
+        todo = []
+        for file in vid_file_list:
+            name = video_cache_name(file)
+            path = os.path.join(cached_dir, name)
+            if name in manifest['done'] and os.path.exists(path):
+                continue
+            if name not in manifest['done'] and is_valid_npy(path):  # cache written before manifests existed
+                manifest['done'][name] = list(np.load(path, mmap_mode='r').shape)
+                if no_manifest:  # by the torchvision / PIL per-frame path
+                    manifest['resize'] = 'pil'
+                continue
+            todo.append((vid_root, file, path, num_frames, resolution, preprocessing_type))
+
+        if todo and manifest['resize'] != VIDEO_CACHE_RESIZE:
+            atomic_save_json(manifest_path, manifest)
+            raise RuntimeError(f'{cached_dir} holds clips resized by {manifest["resize"]}, adding {len(todo)} '
+                               f'{VIDEO_CACHE_RESIZE} clips would mix both; remove the dir to rebuild it')
+        if todo:
+            with Pool(num_workers, initializer=_init_decode_worker) as pool:
+                for i, (file, shape) in enumerate(tqdm(pool.imap_unordered(_cache_one_video, todo),
+                                                       total=len(todo), desc=f'caching {cached_dir}')):
+                    manifest['done'][video_cache_name(file)] = shape
+                    if i % 50 == 0:
+                        atomic_save_json(manifest_path, manifest)
+        atomic_save_json(manifest_path, manifest)
+
+    return cached_dir
+
+
+PYRAMID_DIR = 'pyramid'
+PYRAMID_LRU_FILE = 'lru.json'
+
+
+def pyramid_frame_index(master_frames, num_frames):
+    """master frames closest to the ones load_video_batched samples, a strided view when they line up"""
+    return frame_index(np.round(np.linspace(0, master_frames - 1, num_frames)).astype(int))
+
+
+def derive_clip_variant(master_dir, out_dir, num_frames, resolution, preprocessing_type, block_clips=16,
+                        device=None):
+    """clip store of num_frames x resolution x resolution clips, derived from the raw uint8 master clip store
+
+    Frames are subsampled from the master, then resized (bilinear, antialiased) and rounded / normalized like
+    load_video_batched, block_clips clips at a time on device. Not bit-identical to decoding directly: frames are
+    the nearest master frames, and pixels are resized twice with a uint8 rounding in between.
+    """
+    device = device or ('cuda' if torch.cuda.is_available() else 'cpu')
+    with open(os.path.join(master_dir, CLIPS_INDEX_FILE)) as f:
+        meta = json.load(f)
+    master = np.load(os.path.join(master_dir, CLIPS_FILE), mmap_mode='r')
+    n, c, t, h, w = master.shape
+    frames = pyramid_frame_index(t, num_frames)
+    dtype = np.dtype(np.uint8 if preprocessing_type == 'raw' else np.float32)
+    shape = (n, c, num_frames, resolution, resolution)
+
+    os.makedirs(out_dir, exist_ok=True)
+    store_path = os.path.join(out_dir, CLIPS_FILE)
+    tmp_path = f'{store_path}.tmp{os.getpid()}.npy'
+    out = np.lib.format.open_memmap(tmp_path, mode='w+', dtype=dtype, shape=shape)
+    for i in tqdm(range(0, n, block_clips), desc=f'deriving {out_dir}'):
+        vid = torch.from_numpy(np.ascontiguousarray(master[i:i + block_clips, :, frames])).to(device)
+        b = len(vid)
+        vid = vid.transpose(1, 2).reshape(b * num_frames, c, h, w).float() / 255
+        if (h, w) != (resolution, resolution):
+            vid = K.geometry.transform.resize(vid, (resolution, resolution), interpolation='bilinear',
+                                              antialias=True)
+        if preprocessing_type == 'raw':
+            vid = (vid * 255).round().clamp(0, 255).to(torch.uint8)
+        else:
+            vid = normalize_video(vid, preprocessing_type, channel_dim=1)
+        out[i:i + b] = vid.reshape(b, num_frames, c, resolution, resolution).transpose(1, 2).cpu().numpy()
+    out.flush()
+    del out
+    os.replace(tmp_path, store_path)
+    atomic_save_json(os.path.join(out_dir, CLIPS_INDEX_FILE), dict(meta, shape=list(shape), dtype=dtype.str))
+    return out_dir
+
+
+# {pyramid root: (variant, open pin file)}, the variant this process reads, shared-locked until it moves on
+_PYRAMID_PINS = {}
+
+
+class ClipPyramid(object):
+    """every clip decoded once, at the master resolution and frame count, other caches are derived from it
+
+    The master is the consolidated raw cache of that size. Derived variants are clip stores under
+    pyramid/{master}/{resolution}_{num_frames}_{type}, kept within budget_gb: lru.json records their sizes and last
+    use, the least recently used go first. A process holds a shared flock on {variant}.in_use from variant() until
+    it asks for another variant of the pyramid or exits, and variants someone holds are never evicted (their
+    workers reopen the memmap every epoch), so the budget can be exceeded while they are in use.
+    """
+
+    def __init__(self, dataset_dir, master, budget_gb=100., device=None):
+        self.dataset_dir = dataset_dir
+        self.resolution, self.num_frames = master
+        self.master_dir = video_cache_dir(dataset_dir, self.resolution, self.num_frames, 'raw')
+        self.root = os.path.join(dataset_dir, PYRAMID_DIR, f'{self.resolution}_{self.num_frames}')
+        self.budget_bytes = budget_gb * 2 ** 30
+        self.device = device
+
+    def covers(self, num_frames, resolution):
+        return num_frames <= self.num_frames and resolution <= self.resolution
+
+    def build_master(self, vid_file_list, num_workers=8):
+        """the only decode, a no-op once built"""
+        build_video_cache(self.dataset_dir, vid_file_list, num_frames=self.num_frames, resolution=self.resolution,
+                          preprocessing_type='raw', num_workers=num_workers)
+        build_clip_store(self.master_dir, [os.path.join(self.master_dir, video_cache_name(f))
+                                           for f in vid_file_list])
+        return self.master_dir
+
+    def variant(self, num_frames, resolution, preprocessing_type):
+        """dir of the clip store of that variant, derived on first use"""
+        if (num_frames, resolution, preprocessing_type) == (self.num_frames, self.resolution, 'raw'):
+            return self.master_dir
+        assert self.covers(num_frames, resolution), \
+            f'{resolution}_{num_frames} is beyond the pyramid master {self.resolution}_{self.num_frames}'
+        name = f'{resolution}_{num_frames}_{preprocessing_type}'
+        out_dir = os.path.join(self.root, name)
+        os.makedirs(self.root, exist_ok=True)
+        with file_lock(os.path.join(self.root, '.lock')):
+            lru_path = os.path.join(self.root, PYRAMID_LRU_FILE)
+            lru = {}
+            if os.path.exists(lru_path):
+                with open(lru_path) as f:
+                    lru = json.load(f)
+            if not clip_store_exists(out_dir):
+                derive_clip_variant(self.master_dir, out_dir, num_frames, resolution, preprocessing_type,
+                                    device=self.device)
+            lru[name] = {'bytes': os.path.getsize(os.path.join(out_dir, CLIPS_FILE)), 'used': time.time()}
+            self.pin(name)
+            self.evict(lru, keep=name)
+            atomic_save_json(lru_path, lru)
+        return out_dir
+
+    def pin_path(self, name):
+        return os.path.join(self.root, f'{name}.in_use')
+
+    def pin(self, name):
+        """shared lock on the variant this process reads, releasing the one it read before"""
+        held = _PYRAMID_PINS.get(self.root)
+        if held is not None and held[0] == name:
+            return
+        if held is not None:
+            held[1].close()
+        f = open(self.pin_path(name), 'a')
+        fcntl.flock(f, fcntl.LOCK_SH)
+        _PYRAMID_PINS[self.root] = (name, f)
+
+    def evict(self, lru, keep):
+        total = sum(v['bytes'] for v in lru.values())
+        for name in sorted(lru, key=lambda k: lru[k]['used']):
+            if total <= self.budget_bytes:
+                break
+            if name == keep:
+                continue
+            with open(self.pin_path(name), 'a') as f:
+                try:
+                    fcntl.flock(f, fcntl.LOCK_EX | fcntl.LOCK_NB)
+                except BlockingIOError:  # some job still reads it
+                    continue
+                shutil.rmtree(os.path.join(self.root, name), ignore_errors=True)
+                os.remove(self.pin_path(name))
+            total -= lru.pop(name)['bytes']
+
+
 def wrap_load_fmris(root, file_list):
     fmris = []
     for file in file_list:
@@ -129,6 +380,23 @@ def wrap_load_fmris(root, file_list):
     return fmris
 
 
+def load_fmris(dataset_dir, track, file_df, names, voxel_idxs=None):
+    """[clips, voxels] fmri of the rois (mini track) / subs (full track) concatenated, and their idx_ends
+
+    From the memmapped fmri_store.py store when it was built, otherwise from the per-clip npys.
+    Only the voxel_idxs columns are kept (compact, contiguous rows), idx_ends stay those of all the columns.
+    """
+    store_dir = fmri_store_dir(dataset_dir, track)
+    if fmri_store_exists(store_dir):
+        fmris, idx_ends = FMRIStore(store_dir).load(file_df['vid'].values, names, voxel_idxs=voxel_idxs)
+        return torch.from_numpy(fmris), idx_ends
+    fmris, idx_ends = concat_and_mask(
+        [wrap_load_fmris(os.path.join(dataset_dir, TRACKS[track][0]), file_df[name].values) for name in names])
+    if voxel_idxs is not None:
+        fmris = fmris[:, torch.as_tensor(np.asarray(voxel_idxs), dtype=torch.long)].contiguous()
+    return fmris, idx_ends
+
+
 class ToTensor(object):
 
     def __call__(self, arr):
@@ -147,10 +415,52 @@ class Permute(object):
         return tensor.permute(1, 0, 2, 3)
 
 
+class TensorBatchDataset(Dataset):
+    """a whole split held as (device) tensors, indexed with a list of indices it returns a ready batch
+
+    Used with tensor_batch_loader: no collate, no pickling, no worker processes.
+    """
+
+    def __init__(self, xs, y=None):
+        self.xs = xs
+        self.y = y
+        self.device = next(iter(xs.values())).device
+
+    def __len__(self):
+        return len(next(iter(self.xs.values())))
+
+    def __getitem__(self, indices):
+        indices = torch.as_tensor(indices, device=self.device)
+        x = {k: v.index_select(0, indices) for k, v in self.xs.items()}
+        if self.y is None:
+            return x
+        return x, self.y.index_select(0, indices)
+
+
+def tensor_batch_loader(dataset, batch_size, shuffle):
+    sampler = RandomSampler(dataset) if shuffle else SequentialSampler(dataset)
+    # batch_size=None: the dataset gets the whole index list of a batch and returns the batch itself
+    return DataLoader(dataset, batch_size=None, sampler=BatchSampler(sampler, batch_size, drop_last=False),
+                      num_workers=0)
+
+
+def to_tensor_batch_dataset(dataset, device):
+    """stack every sample of a (Subset of a) dataset into a TensorBatchDataset on device"""
+    if isinstance(dataset, Subset):
+        dataset, indices = dataset.dataset, dataset.indices
+    else:
+        indices = range(len(dataset))
+    samples = [dataset[i] for i in tqdm(indices, desc=f'loading to {device}')]
+    xs = samples if not dataset.train else [x for x, _ in samples]
+    xs = {k: torch.stack([torch.as_tensor(x[k]) for x in xs]).to(device) for k in xs[0].keys()}
+    y = torch.stack([torch.as_tensor(y) for _, y in samples]).float().to(device) if dataset.train else None
+    return TensorBatchDataset(xs, y)
+
+
 class AlgonautsDatasetFreeze(Dataset):
     def __init__(self, dataset_dir, rois='EBA',
                  train=True, cached=True, track='mini_track', subs='all',
-                 voxel_idxs=None, preprocessing_type='flow'):
+                 voxel_idxs=None, preprocessing_type='flow', features_dir=None, features_layers=None):
         self.preprocessing_type = preprocessing_type
         self.voxel_idxs = voxel_idxs
         self.track = track
@@ -170,6 +480,9 @@ class AlgonautsDatasetFreeze(Dataset):
             post_fix = '_flow.pkl'
         elif self.preprocessing_type == 'vggish':
             post_fix = '_vggish.npy'
+        elif self.preprocessing_type == 'features':  # backbone outputs from feature_cache.py, keyed by mp4 name
+            post_fix = '.mp4'
+            self.feature_store = FeatureStore(features_dir, self.vid_file_list, features_layers)
         self.vid_file_list = [x.replace('.mp4', post_fix) for x in self.vid_file_list]
         self.vid_root = os.path.join(self.dataset_dir, 'numpy')
         if self.track == 'full_track':
@@ -178,20 +491,12 @@ class AlgonautsDatasetFreeze(Dataset):
         # load fmri
         if train:
             if self.track == 'mini_track':
-                fmri_dir = 'fmris-mini'
-                self.fmris, self.idx_ends = concat_and_mask(
-                    [wrap_load_fmris(os.path.join(self.dataset_dir, fmri_dir),
-                                     self.file_df[roi].values)
-                     for roi in self.rois.split(',')])
+                self.fmris, self.idx_ends = load_fmris(self.dataset_dir, self.track, self.file_df,
+                                                       self.rois.split(','), voxel_idxs=self.voxel_idxs)
             elif self.track == 'full_track':
-                fmri_dir = 'fmris-full'
                 assert self.rois == 'WB'
-                self.fmris, self.idx_ends = concat_and_mask(
-                    [wrap_load_fmris(os.path.join(self.dataset_dir, fmri_dir), self.file_df[sub].values)
-                     for sub in self.subs])
-
-                # if self.voxel_idxs is not None:
-                #     self.fmris = self.fmris[:, self.voxel_idxs]
+                self.fmris, self.idx_ends = load_fmris(self.dataset_dir, self.track, self.file_df, self.subs,
+                                                       voxel_idxs=self.voxel_idxs)
 
             if self.track == 'full_track':
                 self.sub_idx_ends = self.idx_ends
@@ -213,28 +518,135 @@ class AlgonautsDatasetFreeze(Dataset):
                 # print(index, e)
                 x = np.zeros(128 * 3).astype(np.float32)
             x = {'audio': torch.tensor(x).squeeze(0)}
+        elif self.preprocessing_type == 'features':
+            x = self.feature_store[index]
         else:
             NotImplementedError()
 
         if self.train:
-            if self.voxel_idxs is not None:
-                y = self.fmris[index, self.voxel_idxs]
-            else:
-                y = self.fmris[index]
+            y = self.fmris[index]  # voxel_idxs were selected at load time
             return x, y
         else:
             return x
 
 
+class EpochSampler(Sampler):
+    """yields (epoch, index) so per-sample randomness in the workers depends only on (seed, epoch, index)
+
+    Lightning calls set_epoch on the train sampler before every epoch's loader iterator is created.
+    """
+
+    def __init__(self, num_samples, shuffle=True, seed=0):
+        self.num_samples = num_samples
+        self.shuffle = shuffle
+        self.seed = seed
+        self.epoch = 0
+
+    def set_epoch(self, epoch):
+        self.epoch = epoch
+
+    def __len__(self):
+        return self.num_samples
+
+    def __iter__(self):
+        if self.shuffle:
+            generator = torch.Generator().manual_seed(self.seed * 100003 + self.epoch)
+            order = torch.randperm(self.num_samples, generator=generator)
+        else:
+            order = torch.arange(self.num_samples)
+        return iter([(self.epoch, i) for i in order.tolist()])
+
+
+class AugmentedSubset(Dataset):
+    """crops clips to crop_size x crop_size in the loader, before they are copied out of the (memmapped) clip
+
+    Random crops (train) and augmentation params are drawn from a generator seeded with (seed, epoch, index),
+    index being the position in this dataset, so they do not depend on workers or batch order. With augment,
+    x['aug'] holds [flip, angle in radians], applied on the gpu by DataAugmentation. Keys without 'video'
+    (cached features) pass through untouched.
+    """
+
+    def __init__(self, dataset, crop_size=0, random_crop=False, augment=False, degrees=15., seed=0):
+        self.dataset = dataset
+        self.crop_size = crop_size
+        self.random_crop = random_crop
+        self.augment = augment
+        self.degrees = degrees
+        self.seed = seed
+
+    def __len__(self):
+        return len(self.dataset)
+
+    def __getattr__(self, name):  # indices, vid_file_list, ... of the wrapped dataset
+        if name == 'dataset':
+            raise AttributeError(name)
+        return getattr(self.dataset, name)
+
+    def params(self, epoch, index, size):
+        rng = np.random.default_rng([self.seed, epoch, index])
+        h, w = size
+        if self.crop_size <= 0:
+            top, left = 0, 0
+        elif self.random_crop:
+            top, left = rng.integers(0, h - self.crop_size + 1), rng.integers(0, w - self.crop_size + 1)
+        else:
+            top, left = (h - self.crop_size) // 2, (w - self.crop_size) // 2
+        flip = float(rng.random() < 0.5)
+        angle = rng.uniform(-self.degrees, self.degrees) * np.pi / 180 if rng.random() < 0.5 else 0.
+        return top, left, flip, angle
+
+    def __getitem__(self, key):
+        epoch, index = key if isinstance(key, tuple) else (0, key)
+        item = self.dataset[index]
+        x = item[0] if isinstance(item, tuple) else item
+        if 'video' in x:
+            vid = x['video']
+            top, left, flip, angle = self.params(epoch, index, vid.shape[-2:])
+            x = dict(x)
+            if self.crop_size > 0:
+                vid = vid[..., top:top + self.crop_size, left:left + self.crop_size]
+            # only the crop is copied out of a memmap / preloaded clip
+            x['video'] = torch.from_numpy(np.ascontiguousarray(vid)) if isinstance(vid, np.ndarray) \
+                else vid.contiguous()
+            if self.augment:
+                x['aug'] = torch.tensor([flip, angle], dtype=torch.float32)
+        return (x, *item[1:]) if isinstance(item, tuple) else x
+
+
+# clips preloaded into (shared) memory, kept across datasets / cv folds of the same process, least recently used
+# first; keyed by (store_dir, num_frames, clip paths)
+_PRELOADED_CLIPS = collections.OrderedDict()
+
+
+def evict_preloaded(key, nbytes, ram_budget_bytes):
+    """drop clips of other caches (resolution / frames), then the least recently used, until nbytes more fit"""
+    for k in list(_PRELOADED_CLIPS):
+        if k[:2] != key[:2]:
+            del _PRELOADED_CLIPS[k]
+    while _PRELOADED_CLIPS and \
+            sum(c.numel() * c.element_size() for c in _PRELOADED_CLIPS.values()) + nbytes > ram_budget_bytes:
+        _PRELOADED_CLIPS.popitem(last=False)
+
+
+def available_ram_bytes():
+    return os.sysconf('SC_AVPHYS_PAGES') * os.sysconf('SC_PAGE_SIZE')
+
+
 class AlgonautsDataset(Dataset):
     def __init__(self, dataset_dir,
                  additional_features='',
                  additional_features_dir='',
                  rois='EBA', num_frames=16, resolution=288,
                  train=True, cached=True, track='mini_track', subs='all',
-                 preprocessing_type='mmit', voxel_idxs=None):
+                 preprocessing_type='mmit', voxel_idxs=None, consolidated=False, compact=False,
+                 pyramid='', pyramid_budget_gb=100.):
         self.voxel_idxs = voxel_idxs
+        self.pyramid = pyramid
+        self.pyramid_budget_gb = pyramid_budget_gb
         self.track = track
+        self.compact = compact
+        # compact flow lives in an fp16 copy of the consolidated store
+        self.consolidated = consolidated or (compact and preprocessing_type == 'i3d_flow')
         self.preprocessing_type = preprocessing_type
         self.additional_features_dir = additional_features_dir
         self.additional_features = additional_features
@@ -267,49 +679,57 @@ class AlgonautsDataset(Dataset):
         else:
             self.additional_features = []
 
+        # compact: cache raw uint8 frames, LitModel normalizes them on the gpu (LitModel.normalize_input)
+        self.cache_type = 'raw' if self.compact else self.preprocessing_type
+        self.from_pyramid = False
         if not self.preprocessing_type == 'i3d_flow': # load mp4
-            if self.cached:
-                self.cached_dir = os.path.join(self.dataset_dir,
-                                               f'{self.resolution}_{self.num_frames}_{self.preprocessing_type}_npy')
-                # save to np
-                os.makedirs(self.cached_dir, exist_ok=True)
-                for file in self.vid_file_list:
-                    name = os.path.basename(file).replace('.mp4', '.npy')
-                    path = os.path.join(self.cached_dir, name)
-                    if not os.path.exists(path):
-                        vid = wrap_load_one_video(self.vid_root, file,
-                                                  num_frames=self.num_frames,
-                                                  resolution=self.resolution,
-                                                  preprocessing_type=self.preprocessing_type)
-                        np.save(path, vid.numpy())
+            # '{resolution}_{num_frames}' master, sizes it covers are derived from it instead of decoded
+            pyramid = ClipPyramid(self.dataset_dir, [int(v) for v in self.pyramid.split('_')],
+                                  budget_gb=self.pyramid_budget_gb) if self.pyramid else None
+            if pyramid is not None and pyramid.covers(self.num_frames, self.resolution):
+                pyramid.build_master(pd.read_csv(os.path.join(self.dataset_dir, 'full_vid.csv'))['vid'].values)
+                self.cached_dir = pyramid.variant(self.num_frames, self.resolution, self.cache_type)
+                self.from_pyramid = True
+                self.consolidated = True  # variants only exist as clip stores
+            elif self.cached:
+                # no-op when build_cache.py (or another job) already filled the cache
+                self.cached_dir = build_video_cache(self.dataset_dir, self.vid_file_list,
+                                                    num_frames=self.num_frames,
+                                                    resolution=self.resolution,
+                                                    preprocessing_type=self.cache_type)
             else:
                 NotImplementedError()
-            self.np_paths = [os.path.join(self.cached_dir, os.path.basename(f).replace('.mp4', '.npy'))
-                             for f in self.vid_file_list]
+            self.store_dir = self.cached_dir
         else: # load numpy
             # load on call
-            self.np_paths = [os.path.join(self.flow_dir, os.path.basename(f).replace('.mp4', '_flow_raft.npy'))
-                             for f in self.vid_file_list]
+            self.store_dir = self.flow_dir if not self.compact else os.path.join(self.flow_dir, 'fp16')
             self.frame_idxs = np.linspace(0, 64-1, self.num_frames).astype('int')
-
+            self.frame_slice = frame_index(self.frame_idxs)
+        self.np_paths = self.clip_paths(self.vid_file_list)
+
+        # one [N, C, T, H, W] memmap over all clips of full_vid.csv, shared by train and test datasets
+        self.preloaded = None
+        self.clip_store = None
+        if self.consolidated:
+            all_file_list = pd.read_csv(os.path.join(self.dataset_dir, 'full_vid.csv'))['vid'].values
+            if not self.preprocessing_type == 'i3d_flow' and not self.from_pyramid:
+                build_video_cache(self.dataset_dir, all_file_list,
+                                  num_frames=self.num_frames,
+                                  resolution=self.resolution,
+                                  preprocessing_type=self.cache_type)
+            build_clip_store(self.store_dir, self.clip_paths(all_file_list),
+                             dtype='float16' if self.compact and self.preprocessing_type == 'i3d_flow' else None)
+            self.clip_store = ClipStore(self.store_dir, [os.path.basename(p) for p in self.np_paths])
 
         # load fmri
         if train:
             if self.track == 'mini_track':
-                fmri_dir = 'fmris-mini'
-                self.fmris, self.idx_ends = concat_and_mask(
-                    [wrap_load_fmris(os.path.join(self.dataset_dir, fmri_dir),
-                                     self.file_df[roi].values)
-                     for roi in self.rois.split(',')])
+                self.fmris, self.idx_ends = load_fmris(self.dataset_dir, self.track, self.file_df,
+                                                       self.rois.split(','), voxel_idxs=self.voxel_idxs)
             elif self.track == 'full_track':
-                fmri_dir = 'fmris-full'
                 assert self.rois == 'WB'
-                self.fmris, self.idx_ends = concat_and_mask(
-                    [wrap_load_fmris(os.path.join(self.dataset_dir, fmri_dir), self.file_df[sub].values)
-                     for sub in self.subs])
-
-                # if self.voxel_idxs is not None:
-                #     self.fmris = self.fmris[:, self.voxel_idxs]
+                self.fmris, self.idx_ends = load_fmris(self.dataset_dir, self.track, self.file_df, self.subs,
+                                                       voxel_idxs=self.voxel_idxs)
 
             if self.track == 'full_track':
                 self.sub_idx_ends = self.idx_ends
@@ -318,22 +738,64 @@ class AlgonautsDataset(Dataset):
     def __len__(self):
         return len(self.vid_file_list)
 
+    def clip_paths(self, file_list):
+        if not self.preprocessing_type == 'i3d_flow':
+            return [os.path.join(self.cached_dir, video_cache_name(f)) for f in file_list]
+        return [os.path.join(self.flow_dir, os.path.basename(f).replace('.mp4', '_flow_raft.npy'))
+                for f in file_list]
+
+    def load_clip(self, index):
+        if self.clip_store is not None:
+            vid = self.clip_store[index]  # zero-copy view into the memmap
+        else:
+            vid = np.load(self.np_paths[index])
+        if self.preprocessing_type == 'i3d_flow':
+            vid = vid[:, self.frame_slice, ...]
+        return vid
+
+    def clips_nbytes(self):
+        if self.clip_store is not None:
+            shape, dtype = self.clip_store.shape[1:], self.clip_store.dtype
+        else:
+            first = np.load(self.np_paths[0], mmap_mode='r')
+            shape, dtype = first.shape, first.dtype
+        if self.preprocessing_type == 'i3d_flow':
+            shape = (shape[0], len(self.frame_idxs), *shape[2:])
+        return len(self) * int(np.prod(shape)) * dtype.itemsize
+
+    def preload(self, ram_budget_bytes):
+        """load every clip into one shared-memory tensor if it fits the budget, return whether it did"""
+        key = (self.store_dir, self.num_frames, tuple(self.np_paths))
+        if key not in _PRELOADED_CLIPS:
+            nbytes = self.clips_nbytes()
+            if nbytes > ram_budget_bytes:
+                return False
+            evict_preloaded(key, nbytes, ram_budget_bytes)
+            if nbytes > available_ram_bytes():
+                return False
+            first = torch.from_numpy(np.ascontiguousarray(self.load_clip(0)))
+            clips = torch.empty((len(self), *first.shape), dtype=first.dtype)
+            for i in tqdm(range(len(self)), desc='preloading clips'):
+                clips[i] = torch.from_numpy(np.ascontiguousarray(self.load_clip(i)))
+            _PRELOADED_CLIPS[key] = clips.share_memory_()
+        _PRELOADED_CLIPS.move_to_end(key)
+        self.preloaded = _PRELOADED_CLIPS[key]
+        return True
+
     def __getitem__(self, index):
 
         # print(self.np_paths[index])
-        vid = np.load(self.np_paths[index])
-        if self.preprocessing_type == 'i3d_flow':
-            vid = vid[:, self.frame_idxs, ...]
+        if self.preloaded is not None:
+            vid = self.preloaded[index]
+        else:
+            vid = self.load_clip(index)
 
         x = {'video': vid}
         additional_features = {af: self.features[af][index] for af in self.additional_features}
         x.update(additional_features)
 
         if self.train:
-            if self.voxel_idxs is not None:
-                y = self.fmris[index, self.voxel_idxs]
-            else:
-                y = self.fmris[index]
+            y = self.fmris[index]  # voxel_idxs were selected at load time
             return x, y
         else:
             return x
@@ -358,8 +820,38 @@ class AlgonautsDataModule(pl.LightningDataModule):
                  fold=-1,
                  preprocessing_type='mmit',
                  load_from_np=False,
-                 voxel_idxs=None):
+                 voxel_idxs=None,
+                 features_dir=None,
+                 features_layers=None,
+                 consolidated=False,
+                 compact=False,
+                 num_workers=8,
+                 preload_ram_gb=0.,
+                 gpu_resident=False,
+                 crop_size=0,
+                 random_crop=False,
+                 augment=False,
+                 augment_degrees=15.,
+                 augment_seed=0,
+                 pyramid='',
+                 pyramid_budget_gb=100.):
         super().__init__()
+        self.pyramid = pyramid
+        self.pyramid_budget_gb = pyramid_budget_gb
+        self.crop_size = crop_size
+        self.random_crop = random_crop
+        self.augment = augment
+        self.augment_degrees = augment_degrees
+        self.augment_seed = augment_seed
+        self.gpu_resident = gpu_resident
+        self.resident_datasets = {}
+        self.num_workers = num_workers
+        self.preload_ram_gb = preload_ram_gb
+        self.preloaded = False
+        self.compact = compact
+        self.consolidated = consolidated
+        self.features_dir = features_dir
+        self.features_layers = features_layers
         self.voxel_idxs = voxel_idxs
         self.load_from_np = load_from_np
         self.preprocessing_type = preprocessing_type
@@ -386,6 +878,10 @@ class AlgonautsDataModule(pl.LightningDataModule):
         self.train_dataset = None
         self.val_dataset = None
         self.test_dataset = None
+        self.feature_batch_size = batch_size
+        self.feature_train_dataset = None
+        self.feature_val_dataset = None
+        self.feature_test_dataset = None
 
         self._has_setup_predict_all = True
 
@@ -412,6 +908,10 @@ class AlgonautsDataModule(pl.LightningDataModule):
                     subs=self.subs,
                     preprocessing_type=self.preprocessing_type,
                     voxel_idxs=self.voxel_idxs,
+                    consolidated=self.consolidated,
+                    compact=self.compact,
+                    pyramid=self.pyramid,
+                    pyramid_budget_gb=self.pyramid_budget_gb,
                 )
             else:
                 self.algonauts_full = AlgonautsDatasetFreeze(
@@ -423,27 +923,19 @@ class AlgonautsDataModule(pl.LightningDataModule):
                     subs=self.subs,
                     voxel_idxs=self.voxel_idxs,
                     preprocessing_type=self.preprocessing_type,
+                    features_dir=self.features_dir,
+                    features_layers=self.features_layers,
                 )
             self.idx_ends = self.algonauts_full.idx_ends.tolist()
+            sub_idx_ends = getattr(self.algonauts_full, 'sub_idx_ends', None)
+            self.sub_idx_ends = sub_idx_ends.tolist() if sub_idx_ends is not None else None
+            self.preloaded = self.maybe_preload(self.algonauts_full)
 
-            if not self.use_cv:
-                num_train = int(self.train_full_len * (1 - self.val_ratio))
-                num_val = int(self.train_full_len * self.val_ratio)
-                if self.random_split:
-                    self.train_dataset, self.val_dataset = random_split(self.algonauts_full, [num_train, num_val],
-                                                                        generator=torch.Generator().manual_seed(42))
-                else:
-                    lengths = [num_train, num_val]
-                    indices = np.arange(sum(lengths)).tolist()
-                    self.train_dataset, self.val_dataset = \
-                        [Subset(self.algonauts_full, indices[offset - length: offset]) for offset, length in
-                         zip(_accumulate(lengths), lengths)]
-            else:
-                assert self.num_split > 0
-                kf = KFold(n_splits=self.num_split)
-                train, val = list(kf.split(np.arange(self.train_full_len)))[self.fold]
-                self.train_dataset = Subset(self.algonauts_full, train)
-                self.val_dataset = Subset(self.algonauts_full, val)
+            self.train_dataset, self.val_dataset = self.split(self.algonauts_full)
+            if self.crops_on_host():
+                self.train_dataset = AugmentedSubset(self.train_dataset, self.crop_size, self.random_crop,
+                                                     self.augment, self.augment_degrees, self.augment_seed)
+                self.val_dataset = AugmentedSubset(self.val_dataset, self.crop_size)
 
             self.num_voxels = self.train_dataset[0][1].shape[0]
 
@@ -463,6 +955,10 @@ class AlgonautsDataModule(pl.LightningDataModule):
                     subs=self.subs,
                     preprocessing_type=self.preprocessing_type,
                     voxel_idxs=self.voxel_idxs,
+                    consolidated=self.consolidated,
+                    compact=self.compact,
+                    pyramid=self.pyramid,
+                    pyramid_budget_gb=self.pyramid_budget_gb,
                 )
             else:
                 self.test_dataset = AlgonautsDatasetFreeze(
@@ -474,23 +970,131 @@ class AlgonautsDataModule(pl.LightningDataModule):
                     subs=self.subs,
                     voxel_idxs=self.voxel_idxs,
                     preprocessing_type=self.preprocessing_type,
+                    features_dir=self.features_dir,
+                    features_layers=self.features_layers,
                 )
+            if self.crops_on_host():
+                self.test_dataset = AugmentedSubset(self.test_dataset, self.crop_size)
+
+    def crops_on_host(self):
+        return not self.load_from_np and (self.crop_size > 0 or self.augment)
+
+    def split(self, full):
+        if not self.use_cv:
+            num_train = int(self.train_full_len * (1 - self.val_ratio))
+            num_val = int(self.train_full_len * self.val_ratio)
+            if self.random_split:
+                train_dataset, val_dataset = random_split(full, [num_train, num_val],
+                                                          generator=torch.Generator().manual_seed(42))
+            else:
+                lengths = [num_train, num_val]
+                indices = np.arange(sum(lengths)).tolist()
+                train_dataset, val_dataset = \
+                    [Subset(full, indices[offset - length: offset]) for offset, length in
+                     zip(_accumulate(lengths), lengths)]
+        else:
+            assert self.num_split > 0
+            kf = KFold(n_splits=self.num_split)
+            train, val = list(kf.split(np.arange(self.train_full_len)))[self.fold]
+            train_dataset = Subset(full, train)
+            val_dataset = Subset(full, val)
+        return train_dataset, val_dataset
+
+    def attach_features(self, features_dir, layers, batch_size=None, predict=False):
+        """cached backbone outputs (feature_cache.py) for the epochs the LitModel runs with a frozen backbone
+
+        Split like the video datasets, so both phases see the same train / val clips.
+        """
+        self.features_dir = features_dir
+        self.features_layers = layers
+        self.feature_batch_size = self.batch_size if batch_size is None else batch_size
+        kwargs = dict(rois=self.rois, cached=self.cached, track=self.track, subs=self.subs,
+                      voxel_idxs=self.voxel_idxs, preprocessing_type='features',
+                      features_dir=features_dir, features_layers=layers)
+        self.feature_train_dataset, self.feature_val_dataset = \
+            self.split(AlgonautsDatasetFreeze(self.datasets_dir, train=True, **kwargs))
+        self.feature_test_dataset = AlgonautsDatasetFreeze(self.datasets_dir, train=False, **kwargs) \
+            if predict else None
+
+    def serve_features(self):
+        return self.feature_train_dataset is not None and self.trainer is not None and \
+               self.trainer.lightning_module.backbone_frozen()
+
+    def feature_loader(self, split, dataset, shuffle):
+        if self.gpu_resident:
+            return self.resident_loader(f'features_{split}', dataset, shuffle, batch_size=self.feature_batch_size)
+        return DataLoader(dataset, batch_size=self.feature_batch_size, shuffle=shuffle,
+                          **self.loader_kwargs(False))
+
+    def maybe_preload(self, dataset):
+        if self.preload_ram_gb <= 0 or self.load_from_np:
+            return False
+        dataset = dataset.dataset if isinstance(dataset, AugmentedSubset) else dataset
+        return dataset.preload(self.preload_ram_gb * 2 ** 30)
+
+    def loader_kwargs(self, preloaded):
+        # indexing a preloaded tensor is cheaper than shipping batches back from worker processes
+        num_workers = 0 if preloaded else self.num_workers
+        if num_workers == 0:
+            return {'num_workers': 0, 'pin_memory': False}
+        return {'num_workers': num_workers, 'pin_memory': False, 'prefetch_factor': 2}
+
+    def resident_loader(self, split, dataset, shuffle, batch_size=None):
+        """frozen features + fmri of a whole split kept on the training device, batches are index_selects"""
+        if split not in self.resident_datasets:
+            if self.trainer is not None:
+                device = self.trainer.lightning_module.device
+            else:
+                device = torch.device('cuda' if torch.cuda.is_available() else 'cpu')
+            self.resident_datasets[split] = to_tensor_batch_dataset(dataset, device)
+        batch_size = self.batch_size if batch_size is None else batch_size
+        return tensor_batch_loader(self.resident_datasets[split], batch_size, shuffle)
 
     def train_dataloader(self):
+        if self.serve_features():
+            return self.feature_loader('train', self.feature_train_dataset, shuffle=True)
+        # fine-tune phase, free the resident features
+        self.resident_datasets.pop('features_train', None)
+        self.resident_datasets.pop('features_val', None)
+        if self.gpu_resident and self.load_from_np:
+            return self.resident_loader('train', self.train_dataset, shuffle=True)
+        if isinstance(self.train_dataset, AugmentedSubset):  # seeded order, crops and augmentation per epoch
+            return DataLoader(self.train_dataset, batch_size=self.batch_size,
+                              sampler=EpochSampler(len(self.train_dataset), seed=self.augment_seed),
+                              **self.loader_kwargs(self.preloaded))
         return DataLoader(self.train_dataset, batch_size=self.batch_size,
-                          shuffle=True, num_workers=8, pin_memory=False, prefetch_factor=2)
+                          shuffle=True, **self.loader_kwargs(self.preloaded))
 
     def val_dataloader(self):
-        return DataLoader(self.val_dataset, batch_size=self.batch_size,
-                          shuffle=False, num_workers=8, pin_memory=False, prefetch_factor=2)
+        if self.serve_features():
+            return self.feature_loader('val', self.feature_val_dataset, shuffle=False)
+        return self.eval_dataloader(self.val_dataset)
+
+    def eval_dataloader(self, dataset):
+        """in-order loader of a val split, also one the caller kept past teardown('fit')"""
+        if self.gpu_resident and self.load_from_np:
+            return self.resident_loader('val', dataset, shuffle=False)
+        return DataLoader(dataset, batch_size=self.batch_size,
+                          shuffle=False, **self.loader_kwargs(self.preloaded))
 
     def predict_dataloader(self):
+        if self.feature_test_dataset is not None:  # backbone never unfroze
+            return self.feature_loader('predict', self.feature_test_dataset, shuffle=False)
+        if self.gpu_resident and self.load_from_np:
+            return self.resident_loader('predict', self.test_dataset, shuffle=False)
+        preloaded = self.maybe_preload(self.test_dataset)
         return DataLoader(self.test_dataset, batch_size=self.batch_size,
-                          shuffle=False, num_workers=8, pin_memory=False, prefetch_factor=2)
+                          shuffle=False, **self.loader_kwargs(preloaded))
 
     def teardown(self, stage: Optional[str] = None):
         # Used to clean-up when the run is finished
         if stage in (None, 'fit'):
+            self.resident_datasets.pop('train', None)
+            self.resident_datasets.pop('val', None)
+            self.resident_datasets.pop('features_train', None)
+            self.resident_datasets.pop('features_val', None)
+            self.feature_train_dataset = None
+            self.feature_val_dataset = None
             delattr(self, 'train_dataset')
             delattr(self, 'val_dataset')
             delattr(self, 'algonauts_full')
@@ -501,6 +1105,7 @@ class AlgonautsDataModule(pl.LightningDataModule):
             # self.val_dataset = None
             # self.algonauts_full = None
         if stage in (None, 'test'):
+            self.resident_datasets.pop('predict', None)
             delattr(self, 'test_dataset')
             setattr(self, 'test_dataset', None)
             # self.test_dataset = None
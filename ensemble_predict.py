@@ -0,0 +1,157 @@
+import os
+import json
+import pathlib
+import hashlib
+from argparse import ArgumentParser
+from collections import OrderedDict
+
+import numpy as np
+import torch
+from torch.utils.data import DataLoader
+from tqdm import tqdm
+
+from dataloading import AlgonautsDataModule
+from feature_cache import WEIGHT_FIELDS, backbone_features
+from main import LitModel, build_backbone, checkpoint_voxel_idxs
+from utils import atomic_save_json
+
+# hparams that change the backbone's input or output besides its weights
+BACKBONE_FIELDS = ['backbone_type', 'preprocessing_type', 'video_size', 'video_frames', 'crop_size']
+
+
+def backbone_key(ckpt):
+    """checkpoints with the same key can share one backbone forward: same weights (incl. bn stats) and inputs"""
+    h = hashlib.sha1(json.dumps({k: ckpt['hyper_parameters'].get(k) for k in BACKBONE_FIELDS},
+                                sort_keys=True).encode())
+    if ckpt['hyper_parameters']['backbone_type'] not in WEIGHT_FIELDS:  # no dict of features to fan out
+        return None
+    for k in sorted(ckpt['state_dict']):
+        if k.startswith('backbone.'):
+            h.update(k.encode())
+            h.update(ckpt['state_dict'][k].cpu().numpy().tobytes())
+    return h.hexdigest()
+
+
+def group_checkpoints(ckpt_paths):
+    groups = OrderedDict()
+    for i, path in enumerate(ckpt_paths):
+        ckpt = torch.load(path, map_location='cpu')
+        key = backbone_key(ckpt) or f'single-{i}'
+        groups.setdefault(key, []).append(path)
+    return groups
+
+
+def load_group(ckpt_paths, device):
+    """LitModels sharing one backbone module, each with its own neck"""
+    backbone = None
+    models = []
+    for path in ckpt_paths:
+        ckpt = torch.load(path, map_location='cpu')
+        hparams = ckpt['hyper_parameters']
+        if backbone is None:
+            backbone = build_backbone(hparams)
+        plmodel = LitModel(backbone, hparams, voxel_idxs=checkpoint_voxel_idxs(ckpt))
+        if len(models) == 0:
+            plmodel.load_state_dict(ckpt['state_dict'])
+        else:
+            # the shared backbone is loaded already, everything else must match
+            missing, unexpected = plmodel.load_state_dict(
+                {k: v for k, v in ckpt['state_dict'].items() if not k.startswith('backbone.')}, strict=False)
+            missing = [k for k in missing if not k.startswith('backbone.')]
+            if missing or unexpected:
+                raise RuntimeError(f'{path}: missing keys {missing}, unexpected keys {unexpected}')
+        models.append(plmodel.to(device).eval())
+    return models
+
+
+def model_output(plmodel, out):
+    out = out[0]
+    return torch.cat([out[roi] for roi in plmodel.rois], -1)
+
+
+@torch.no_grad()
+def predict_group(models, datasets_dir, batch_size, num_workers, device):
+    hparams = models[0].hparams
+    if hparams.load_from_np:
+        raise NotImplementedError('checkpoints trained on --load_from_np features')
+    dm = AlgonautsDataModule(batch_size=batch_size, datasets_dir=datasets_dir,
+                             rois=hparams.rois, num_frames=hparams.video_frames, resolution=hparams.video_size,
+                             cached=hparams.cached, track=hparams.track, subs=hparams.subs,
+                             preprocessing_type=hparams.preprocessing_type, voxel_idxs=None,
+                             consolidated=hparams.get('consolidated_cache', False),
+                             compact=hparams.get('compact_cache', False), pyramid=hparams.get('pyramid', ''),
+                             num_workers=num_workers)
+    dm.setup('test')
+    loader = DataLoader(dm.test_dataset, batch_size=batch_size, shuffle=False, num_workers=num_workers)
+
+    shared = len(models) > 1 and hparams.backbone_type in WEIGHT_FIELDS
+    layers = sorted({x_i for m in models for x_i in m.hparams.pyramid_layers.split(',')})
+    outs = [[] for _ in models]
+    for x in tqdm(loader, desc=f'{len(models)} necks on {hparams.backbone_type}'):
+        x = {k: v.to(device) for k, v in x.items()}
+        if shared:
+            # backbone once, every neck reads the layers it needs
+            features = backbone_features(models[0], x['video'], layers)
+            for i, plmodel in enumerate(models):
+                outs[i].append(model_output(plmodel, plmodel(features)).float().cpu())
+        else:
+            for i, plmodel in enumerate(models):
+                xi = dict(x)
+                xi['video'] = plmodel.normalize_input(xi['video'])
+                xi['video'] = plmodel.test_transform(xi['video']) if plmodel.test_transform is not None \
+                    else xi['video']
+                outs[i].append(model_output(plmodel, plmodel(xi)).float().cpu())
+    return [torch.cat(o, 0).numpy() for o in outs]
+
+
+def parse_args():
+    parser = ArgumentParser()
+    parser.add_argument('ckpts', type=str, nargs='+', help='checkpoints, or dirs searched for **/*.ckpt')
+    parser.add_argument('--datasets_dir', type=str, default='/home/huze/algonauts_datasets/')
+    parser.add_argument('--output', type=str, required=True, help='writes {output}.npy and {output}.json')
+    parser.add_argument('--batch_size', type=int, default=8)
+    parser.add_argument('--num_workers', type=int, default=8)
+    parser.add_argument('--device', type=str, default='cuda:0' if torch.cuda.is_available() else 'cpu')
+    args = parser.parse_args()
+    return args
+
+
+def main(args):
+    ckpt_paths = []
+    for p in args.ckpts:
+        ckpt_paths += sorted(str(c) for c in pathlib.Path(p).glob('**/*.ckpt')) if os.path.isdir(p) else [p]
+    device = torch.device(args.device)
+
+    groups = group_checkpoints(ckpt_paths)
+    print(f'{len(ckpt_paths)} checkpoints, {len(groups)} backbone forwards per clip')
+    predictions = {}
+    meta = {}
+    for key, paths in groups.items():
+        models = load_group(paths, device)
+        for path, plmodel, pred in zip(paths, models, predict_group(models, args.datasets_dir, args.batch_size,
+                                                                    args.num_workers, device)):
+            predictions[path] = pred
+            voxel_idxs = plmodel.trained_voxel_idxs
+            meta[path] = {'rois': plmodel.rois, 'idx_ends': plmodel.hparams.idx_ends,
+                          'num_voxels': pred.shape[1], 'backbone_group': key,
+                          'voxel_idxs': None if voxel_idxs is None else np.asarray(voxel_idxs).tolist()}
+        del models
+        torch.cuda.empty_cache()
+
+    # [models, clips, voxels], voxel subset models go to their voxel_idxs columns, voxels a model lacks are nan
+    num_clips = len(next(iter(predictions.values())))
+    columns = {path: np.arange(p.shape[1]) if meta[path]['voxel_idxs'] is None else
+               np.asarray(meta[path]['voxel_idxs']) for path, p in predictions.items()}
+    num_voxels = max(int(c.max()) + 1 for c in columns.values())
+    out = np.lib.format.open_memmap(f'{args.output}.npy', mode='w+', dtype=np.float32,
+                                    shape=(len(ckpt_paths), num_clips, num_voxels))
+    out[:] = np.nan
+    for i, path in enumerate(ckpt_paths):
+        out[i][:, columns[path]] = predictions[path]
+    out.flush()
+    atomic_save_json(f'{args.output}.json', {'models': ckpt_paths, 'meta': meta})
+    print('saved ...', f'{args.output}.npy', out.shape)
+
+
+if __name__ == '__main__':
+    main(parse_args())
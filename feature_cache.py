@@ -0,0 +1,124 @@
+import os
+import json
+import hashlib
+
+import numpy as np
+import torch
+from torch.utils.data import DataLoader
+from tqdm import tqdm
+
+from utils import atomic_save_json, file_lock
+
+INDEX_FILE = 'index.json'
+
+# everything that changes what the frozen backbone outputs for a clip
+KEY_FIELDS = ['backbone_type', 'pretrained', 'preprocessing_type', 'video_size', 'video_frames', 'crop_size',
+              'compact_cache']
+WEIGHT_FIELDS = {
+    'i3d_rgb': 'i3d_rgb_dir',
+    'i3d_flow': 'i3d_flow_path',
+    'bit': 'bit_path',
+}
+
+
+def feature_cache_key(hparams):
+    if hparams['backbone_type'] not in WEIGHT_FIELDS:
+        raise NotImplementedError(f"no feature cache for backbone {hparams['backbone_type']}")
+    config = {k: hparams.get(k) for k in KEY_FIELDS}
+    config['weights'] = hparams[WEIGHT_FIELDS[hparams['backbone_type']]]
+    if hparams.get('pyramid'):  # clips derived from a pyramid master differ slightly from decoded ones
+        config['pyramid'] = hparams['pyramid']
+    key = hashlib.sha1(json.dumps(config, sort_keys=True).encode()).hexdigest()[:16]
+    return key, config
+
+
+def extraction_device(args):
+    if not torch.cuda.is_available():
+        return torch.device('cpu')
+    return torch.device('cuda', int(str(args.gpus).split(',')[0]))
+
+
+@torch.no_grad()
+def backbone_features(plmodel, x_vid, layers):
+    """eval-mode backbone outputs for a batch of clips, one row per clip"""
+    x_vid = plmodel.normalize_input(x_vid)
+    x_vid = plmodel.test_transform(x_vid) if plmodel.test_transform is not None else x_vid
+    out_vid = plmodel.forward_backbone(x_vid)
+    out_vid = {k: out_vid[k] for k in layers}
+    if plmodel.hparams.backbone_type == 'bit':  # frames as batch -> B x T x ...
+        out_vid = {k: v.reshape(x_vid.shape[0], x_vid.shape[2], *v.shape[1:]) for k, v in out_vid.items()}
+    return out_vid
+
+
+def extract_features(plmodel, dataset, features_root, device, layers=None, batch_size=8, dtype='float16'):
+    """run the frozen backbone once per clip and config, store every layer as one [N, ...] npy
+
+    The cache dir is keyed by feature_cache_key, layers missing from it are added on demand.
+    dataset should list every clip (full_vid.csv), rows follow its order. Clips are center cropped and not
+    augmented, random crops / augmentation only reach training once the backbone is unfrozen. Batch norm runs on its
+    running stats, the finetune callbacks keep it frozen (train_bn=False) while these features are served.
+    """
+    key, config = feature_cache_key(plmodel.hparams)
+    layers = plmodel.hparams.pyramid_layers.split(',') if layers is None else layers
+    out_dir = os.path.join(features_root, key)
+    os.makedirs(out_dir, exist_ok=True)
+
+    with file_lock(os.path.join(out_dir, '.lock')):
+        missing = [layer for layer in layers if not os.path.exists(os.path.join(out_dir, f'{layer}.npy'))]
+        if missing:
+            was_training = plmodel.training
+            plmodel.to(device).eval()
+            loader = DataLoader(dataset, batch_size=batch_size, shuffle=False, num_workers=4)
+            stores = {}
+            row = 0
+            for x in tqdm(loader, desc=f'extracting {",".join(missing)} to {out_dir}'):
+                feats = backbone_features(plmodel, torch.as_tensor(x['video']).to(device), missing)
+                for layer, f in feats.items():
+                    f = f.cpu().numpy().astype(dtype)
+                    if layer not in stores:
+                        tmp_path = os.path.join(out_dir, f'{layer}.tmp{os.getpid()}.npy')
+                        stores[layer] = (tmp_path, np.lib.format.open_memmap(
+                            tmp_path, mode='w+', dtype=dtype, shape=(len(dataset), *f.shape[1:])))
+                    stores[layer][1][row:row + len(f)] = f
+                row += len(next(iter(feats.values())))
+            for layer, (tmp_path, store) in stores.items():
+                store.flush()
+                del store
+                os.replace(tmp_path, os.path.join(out_dir, f'{layer}.npy'))
+            plmodel.train(was_training)
+
+            names = [os.path.basename(f) for f in dataset.vid_file_list]
+            atomic_save_json(os.path.join(out_dir, INDEX_FILE),
+                             {'config': config, 'index': {name: i for i, name in enumerate(names)}})
+    return out_dir
+
+
+class FeatureStore(object):
+    """per-clip dict of cached backbone features, memmapped lazily in every worker"""
+
+    def __init__(self, features_dir, names, layers):
+        self.features_dir = features_dir
+        self.layers = layers
+        with open(os.path.join(features_dir, INDEX_FILE)) as f:
+            index = json.load(f)['index']
+        self.rows = np.array([index[os.path.basename(name)] for name in names])
+        self._features = None
+
+    @property
+    def features(self):
+        if self._features is None:
+            self._features = {layer: np.load(os.path.join(self.features_dir, f'{layer}.npy'), mmap_mode='r')
+                              for layer in self.layers}
+        return self._features
+
+    def __len__(self):
+        return len(self.rows)
+
+    def __getitem__(self, index):
+        row = self.rows[index]
+        return {layer: torch.from_numpy(np.asarray(f[row], dtype=np.float32)) for layer, f in self.features.items()}
+
+    def __getstate__(self):
+        state = self.__dict__.copy()
+        state['_features'] = None
+        return state
@@ -0,0 +1,166 @@
+import os
+import json
+from argparse import ArgumentParser
+
+import numpy as np
+import pandas as pd
+from tqdm import tqdm
+
+from utils import atomic_save_json, atomic_save_npy, file_lock
+
+STORE_FILE = 'targets.npy'
+INDEX_FILE = 'targets.json'
+MASKS_FILE = 'voxel_masks.npy'
+
+# per-file fmri dir and train csv of each track, the csv columns name the per-clip npys
+TRACKS = {
+    'mini_track': ('fmris-mini', 'train_val-mini.csv'),
+    'full_track': ('fmris-full', 'train_val-full.csv'),
+}
+ROIS = ['LOC', 'FFA', 'STS', 'EBA', 'PPA', 'V1', 'V2', 'V3', 'V4']
+SUBS = [f'sub{i + 1:02d}' for i in range(10)]
+
+
+def fmri_store_dir(dataset_dir, track):
+    return os.path.join(dataset_dir, TRACKS[track][0], 'store')
+
+
+def fmri_store_exists(store_dir):
+    return os.path.exists(os.path.join(store_dir, STORE_FILE)) and \
+           os.path.exists(os.path.join(store_dir, INDEX_FILE))
+
+
+def build_fmri_store(dataset_dir, track, dtype='float32'):
+    """consolidate the per (clip, roi) / (clip, sub) npys of a track into one [clips, voxels] matrix
+
+    Columns are grouped by roi (mini track) or subject (full track), their ranges go to targets.json.
+    The full track's voxel masks are stacked into voxel_masks.npy. Built under a lock, written atomically.
+    """
+    fmri_dir, csv = TRACKS[track]
+    store_dir = fmri_store_dir(dataset_dir, track)
+    os.makedirs(store_dir, exist_ok=True)
+    with file_lock(os.path.join(store_dir, '.store_lock')):
+        if fmri_store_exists(store_dir):
+            return store_dir
+
+        file_df = pd.read_csv(os.path.join(dataset_dir, csv))
+        names = [c for c in (ROIS if track == 'mini_track' else SUBS) if c in file_df.columns]
+        columns, offset = {}, 0
+        for name in names:
+            width = np.load(os.path.join(dataset_dir, fmri_dir, file_df[name].values[0]), mmap_mode='r').shape[-1]
+            columns[name] = [offset, offset + width]
+            offset += width
+
+        store_path = os.path.join(store_dir, STORE_FILE)
+        tmp_path = f'{store_path}.tmp{os.getpid()}.npy'
+        store = np.lib.format.open_memmap(tmp_path, mode='w+', dtype=dtype, shape=(len(file_df), offset))
+        for i in tqdm(range(len(file_df)), desc=f'consolidating {store_dir}'):
+            store[i] = np.concatenate([np.load(os.path.join(dataset_dir, fmri_dir, file_df[name].values[i]))
+                                       for name in names])
+        store.flush()
+        del store
+        os.replace(tmp_path, store_path)
+
+        index = {'clips': list(file_df['vid'].values), 'columns': columns, 'shape': [len(file_df), offset],
+                 'dtype': np.dtype(dtype).str}
+        if track == 'full_track':
+            masks = [np.load(os.path.join(dataset_dir, fmri_dir, f'{sub}_voxel_mask.npy')) for sub in names]
+            atomic_save_npy(os.path.join(store_dir, MASKS_FILE), np.stack(masks, 0))
+            index['mask_subs'] = names
+        atomic_save_json(os.path.join(store_dir, INDEX_FILE), index)
+    return store_dir
+
+
+def save_fmri_store(store_dir, clips, columns, dtype='float32', masks=None):
+    """same store as build_fmri_store from in-memory [clips, width] arrays, {name: array} in column order
+
+    masks: {sub: voxel mask} of the full track.
+    """
+    os.makedirs(store_dir, exist_ok=True)
+    ranges, offset = {}, 0
+    for name, values in columns.items():
+        ranges[name] = [offset, offset + values.shape[1]]
+        offset += values.shape[1]
+    store_path = os.path.join(store_dir, STORE_FILE)
+    tmp_path = f'{store_path}.tmp{os.getpid()}.npy'
+    store = np.lib.format.open_memmap(tmp_path, mode='w+', dtype=dtype, shape=(len(clips), offset))
+    for name, values in columns.items():
+        store[:, ranges[name][0]:ranges[name][1]] = values
+    store.flush()
+    del store
+    os.replace(tmp_path, store_path)
+
+    index = {'clips': list(clips), 'columns': ranges, 'shape': [len(clips), offset], 'dtype': np.dtype(dtype).str}
+    if masks is not None:
+        atomic_save_npy(os.path.join(store_dir, MASKS_FILE), np.stack(list(masks.values()), 0))
+        index['mask_subs'] = list(masks)
+    atomic_save_json(os.path.join(store_dir, INDEX_FILE), index)
+    return store_dir
+
+
+class FMRIStore(object):
+    """memmapped read access to a consolidated fmri store"""
+
+    def __init__(self, store_dir):
+        self.store_dir = store_dir
+        with open(os.path.join(store_dir, INDEX_FILE)) as f:
+            self.index = json.load(f)
+        self.rows = {clip: i for i, clip in enumerate(self.index['clips'])}
+        self._targets = None
+
+    @property
+    def targets(self):
+        if self._targets is None:
+            # copy-on-write, so torch.from_numpy gets a writable array without reading the file
+            self._targets = np.load(os.path.join(self.store_dir, STORE_FILE), mmap_mode='c')
+        return self._targets
+
+    def load(self, clips, names, voxel_idxs=None, block_rows=64):
+        """[clips, voxels] float32 targets of the columns `names` concatenated, and their idx_ends
+
+        voxel_idxs select columns of that concatenation at load time, into a compact copy, so a small voxel subset
+        never holds the whole brain in memory. Stays a memmap when the whole store is asked for in order,
+        otherwise only row blocks of the selected rows are read. idx_ends are those of the full `names` columns.
+        """
+        rows = np.array([self.rows[clip] for clip in clips])
+        ranges = [self.index['columns'][name] for name in names]
+        idx_ends = np.cumsum([end - start for start, end in ranges])
+        cols = np.concatenate([np.arange(start, end) for start, end in ranges])
+        if voxel_idxs is not None:
+            cols = cols[np.asarray(voxel_idxs)]
+        whole = (len(rows) == self.index['shape'][0] and np.array_equal(rows, np.arange(len(rows))) and
+                 np.array_equal(cols, np.arange(self.index['shape'][1])))
+        if whole and self.targets.dtype == np.float32:
+            return self.targets, idx_ends
+        out = np.empty((len(rows), len(cols)), dtype=np.float32)
+        for i in range(0, len(rows), block_rows):
+            out[i:i + block_rows] = self.targets[rows[i:i + block_rows]][:, cols]
+        return out, idx_ends
+
+    def voxel_masks(self, subs):
+        masks = np.load(os.path.join(self.store_dir, MASKS_FILE), mmap_mode='r')
+        return np.stack([masks[self.index['mask_subs'].index(sub)] for sub in subs], 0)
+
+
+def load_voxel_masks(dataset_dir, subs):
+    """[subs, X, Y, Z] full track voxel masks, from the store when it was built"""
+    store_dir = fmri_store_dir(dataset_dir, 'full_track')
+    if fmri_store_exists(store_dir):
+        return FMRIStore(store_dir).voxel_masks(subs)
+    return np.stack([np.load(os.path.join(dataset_dir, TRACKS['full_track'][0], f'{sub}_voxel_mask.npy'))
+                     for sub in subs], 0)
+
+
+def parse_args():
+    parser = ArgumentParser()
+    parser.add_argument('--datasets_dir', type=str, default='/home/huze/algonauts_datasets/')
+    parser.add_argument('--tracks', type=str, default='mini_track,full_track')
+    parser.add_argument('--dtype', type=str, default='float32', help='float32, float16')
+    args = parser.parse_args()
+    return args
+
+
+if __name__ == '__main__':
+    args = parse_args()
+    for track in args.tracks.split(','):
+        print('store ready ...', build_fmri_store(args.datasets_dir, track, dtype=args.dtype))
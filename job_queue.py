@@ -0,0 +1,130 @@
+import os
+import time
+import socket
+import sqlite3
+from collections import namedtuple
+from argparse import ArgumentParser
+
+Job = namedtuple('Job', ['task_id', 'roi', 'video', 'attempts', 'worker'])
+
+SCHEMA = """
+CREATE TABLE IF NOT EXISTS jobs (
+    task_id TEXT NOT NULL,
+    roi TEXT NOT NULL,
+    video INTEGER NOT NULL,
+    status TEXT NOT NULL DEFAULT 'pending',
+    attempts INTEGER NOT NULL DEFAULT 0,
+    worker TEXT,
+    lease_until REAL,
+    error TEXT,
+    PRIMARY KEY (task_id, roi, video)
+)
+"""
+
+
+def default_worker_name(device=''):
+    return f'{socket.gethostname()}:{os.getpid()}:{device}'
+
+
+class JobQueue(object):
+    """sqlite job queue of (task_id, roi, video) units shared by any number of local worker processes
+
+    A worker leases a job for lease_seconds. Expired leases (crashed workers) go back to the queue,
+    a job is failed for good after max_attempts. Only the worker holding the lease can complete it,
+    so write outputs atomically (tmp + rename / ColumnStore.append) before calling complete().
+    """
+
+    def __init__(self, path, lease_seconds=1800., max_attempts=3):
+        self.path = path
+        self.lease_seconds = lease_seconds
+        self.max_attempts = max_attempts
+        self.conn = sqlite3.connect(path, timeout=60., isolation_level=None)
+        self.conn.execute('PRAGMA journal_mode=WAL')
+        self.conn.execute(SCHEMA)
+
+    def add(self, task_id, roi, videos):
+        self.conn.execute('BEGIN IMMEDIATE')
+        self.conn.executemany('INSERT OR IGNORE INTO jobs (task_id, roi, video) VALUES (?, ?, ?)',
+                              [(task_id, roi, int(v)) for v in videos])
+        self.conn.execute('COMMIT')
+
+    def lease(self, worker, task_id, roi, reverse=False):
+        """next pending (or lease-expired) video of task_id / roi, None when nothing is left to hand out"""
+        now = time.time()
+        self.conn.execute('BEGIN IMMEDIATE')  # write lock, no two workers lease the same job
+        try:
+            row = self.conn.execute(
+                f"""SELECT video, attempts FROM jobs
+                    WHERE task_id = ? AND roi = ? AND attempts < ?
+                      AND (status = 'pending' OR (status = 'leased' AND lease_until < ?))
+                    ORDER BY video {'DESC' if reverse else 'ASC'} LIMIT 1""",
+                (task_id, roi, self.max_attempts, now)).fetchone()
+            if row is None:
+                return None
+            video, attempts = row
+            self.conn.execute(
+                """UPDATE jobs SET status = 'leased', attempts = attempts + 1, worker = ?, lease_until = ?
+                   WHERE task_id = ? AND roi = ? AND video = ?""",
+                (worker, now + self.lease_seconds, task_id, roi, video))
+        finally:
+            self.conn.execute('COMMIT')
+        return Job(task_id, roi, video, attempts + 1, worker)
+
+    def _finish(self, job, status, error=None):
+        cur = self.conn.execute(
+            """UPDATE jobs SET status = ?, error = ?, lease_until = NULL
+               WHERE task_id = ? AND roi = ? AND video = ? AND worker = ? AND status = 'leased'""",
+            (status, error, job.task_id, job.roi, job.video, job.worker))
+        return cur.rowcount == 1
+
+    def renew(self, job):
+        cur = self.conn.execute(
+            """UPDATE jobs SET lease_until = ? WHERE task_id = ? AND roi = ? AND video = ? AND worker = ?
+               AND status = 'leased'""",
+            (time.time() + self.lease_seconds, job.task_id, job.roi, job.video, job.worker))
+        return cur.rowcount == 1
+
+    def complete(self, job):
+        """False if the lease was lost (expired and taken over), the output is then someone else's"""
+        return self._finish(job, 'done')
+
+    def fail(self, job, error=''):
+        return self._finish(job, 'pending' if job.attempts < self.max_attempts else 'failed', str(error))
+
+    def counts(self, task_id=None, roi=None):
+        query = 'SELECT status, COUNT(*) FROM jobs'
+        params = []
+        if task_id is not None:
+            query += ' WHERE task_id = ? AND roi = ?'
+            params = [task_id, roi]
+        return dict(self.conn.execute(query + ' GROUP BY status', params).fetchall())
+
+    def retry_failed(self, task_id, roi):
+        self.conn.execute("""UPDATE jobs SET status = 'pending', attempts = 0, error = NULL
+                             WHERE task_id = ? AND roi = ? AND status = 'failed'""", (task_id, roi))
+
+    def jobs(self, worker, task_id, roi, reverse=False):
+        """lease jobs until the queue is drained"""
+        while True:
+            job = self.lease(worker, task_id, roi, reverse=reverse)
+            if job is None:
+                return
+            yield job
+
+
+def parse_args():
+    parser = ArgumentParser()
+    parser.add_argument('queue', type=str)
+    parser.add_argument('--task_id', type=str, default=None)
+    parser.add_argument('--roi', type=str, default=None)
+    parser.add_argument('--retry_failed', default=False, action="store_true")
+    args = parser.parse_args()
+    return args
+
+
+if __name__ == '__main__':
+    args = parse_args()
+    queue = JobQueue(args.queue)
+    if args.retry_failed:
+        queue.retry_failed(args.task_id, args.roi)
+    print(queue.counts(args.task_id, args.roi))
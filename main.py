@@ -2,14 +2,13 @@ import json
 from argparse import ArgumentParser
 from typing import Any, Optional
 
-import kornia as K
-from kornia.augmentation import RandomCrop3D, CenterCrop3D
 import pytorch_lightning as pl
 from adabelief_pytorch import AdaBelief
 from pytorch_lightning.callbacks import BackboneFinetuning, ModelCheckpoint, EarlyStopping, StochasticWeightAveraging
 from pytorch_lightning.core.lightning import LightningModule
 from pytorch_lightning import loggers as pl_loggers
 from pytorch_lightning.plugins import DDPPlugin
+from pytorch_lightning.utilities import rank_zero_info
 from torch import Tensor
 from torch.nn import SyncBatchNorm
 from torch.optim.lr_scheduler import MultiStepLR, StepLR
@@ -20,12 +19,15 @@ from callbacks import ReduceAuxLossWeight, HalfScoreFinetuning
 
 from bdcn import load_bdcn
 from bdcn_neck import BDCNNeck
-from dataloading import AlgonautsDataModule
+from dataloading import AlgonautsDataModule, normalize_video
+from feature_cache import extract_features, extraction_device
+from fmri_store import load_voxel_masks
 from i3d_flow import load_i3d_flow
 from model_i3d import *
 from sam import SAM
 from utils import *
 from pyramidpooling3d import *
+from prediction_store import model_key, save_predictions
 import pandas as pd
 
 from clearml import Task, Logger
@@ -35,24 +37,25 @@ from vggish_neck import VggishNeck
 PROJECT_NAME = 'kROI explore'
 
 class DataAugmentation(nn.Module):
-    """Module to perform data augmentation using Kornia on torch tensors."""
-
-    def __init__(self) -> None:
-        super().__init__()
-
-        self.transforms = nn.Sequential(
-            K.augmentation.RandomHorizontalFlip3D(p=0.5),
-            K.augmentation.RandomRotation3D(degrees=15, p=0.5),
-            # K.augmentation.RandomAffine3D(p=0.5,
-            #                               degrees=15,
-            #                               translate=(0.1, 0.1, 0),
-            #                               )
-        )
+    """horizontal flip and in-plane rotation of [B, C, T, H, W] clips, fused into one affine resample
+
+    The per clip [flip, angle] come from the loader (dataloading.AugmentedSubset), so they are seeded and
+    reproducible; the same transform is applied to every frame of a clip.
+    """
 
     @torch.no_grad()  # disable gradients for efficiency
-    def forward(self, x: torch.Tensor) -> torch.Tensor:
-        x_out = self.transforms(x)  # BxCxDxHxW
-        return x_out
+    def forward(self, x: torch.Tensor, params: torch.Tensor) -> torch.Tensor:
+        b, c, t, h, w = x.shape
+        params = params.to(device=x.device, dtype=torch.float32)
+        sx = 1 - 2 * params[:, 0]  # -1 mirrors the sampled x coordinate
+        cos, sin = torch.cos(params[:, 1]), torch.sin(params[:, 1])
+        zeros = torch.zeros_like(cos)
+        theta = torch.stack([torch.stack([cos * sx, -sin, zeros], -1),
+                             torch.stack([sin * sx, cos, zeros], -1)], 1)
+        grid = F.affine_grid(theta, [b, c * t, h, w], align_corners=False)
+        out = F.grid_sample(x.reshape(b, c * t, h, w).float(), grid, mode='bilinear', padding_mode='zeros',
+                            align_corners=False)
+        return out.reshape(b, c, t, h, w).to(x.dtype)
 
 
 class LitModel(LightningModule):
@@ -60,6 +63,7 @@ class LitModel(LightningModule):
     def __init__(self, backbone, hparams: dict, *args, **kwargs):
         super(LitModel, self).__init__()
         self.save_hyperparameters(hparams, ignore='voxel_idxs')
+        self.trained_voxel_idxs = kwargs.get('voxel_idxs')  # not an hparam, saved by on_save_checkpoint
         # self.hparams = hparams
         self.lr = self.hparams.learning_rate
         self.rois = [self.hparams.rois] if not self.hparams.separate_rois else self.hparams.rois.split(',')
@@ -67,15 +71,14 @@ class LitModel(LightningModule):
         # self.automatic_optimization = False
 
         if self.hparams.crop_size > 0:
-            if self.hparams.random_crop:
-                self.train_transform = RandomCrop3D(
-                    (self.hparams.video_frames, self.hparams.crop_size, self.hparams.crop_size))
-            else:
-                self.train_transform = TensorCenterCrop(self.hparams.crop_size)
+            # clips from the datamodule are cropped in the loader already (random for train), this is a no-op
+            # for them and crops inputs that come from elsewhere
+            self.train_transform = TensorCenterCrop(self.hparams.crop_size)
             self.test_transform = TensorCenterCrop(self.hparams.crop_size)
         else:
             self.train_transform = None
             self.test_transform = None
+        self.augmentation = DataAugmentation()
 
         self.backbone = backbone
 
@@ -95,17 +98,19 @@ class LitModel(LightningModule):
         if self.hparams.track == 'full_track' and not self.hparams.no_convtrans:
             # voxel mask
             subs = [f'sub{i + 1:02d}' for i in range(10)] if self.hparams.subs == 'all' else self.hparams.subs.split(',')
-            voxel_masks = []
-            for sub in subs:
-                voxel_mask = np.load(os.path.join(hparams['datasets_dir'], 'fmris-full', f'{sub}_voxel_mask.npy'))
-                voxel_mask = torch.tensor(voxel_mask, device=self.device)
-                voxel_mask = F.pad(voxel_mask, (4, 4, 1, 1, 0, 1))
-                voxel_masks.append(voxel_mask)
-            self.voxel_masks = torch.stack(voxel_masks, 0)
+            voxel_masks = torch.tensor(load_voxel_masks(hparams['datasets_dir'], subs), device=self.device)
+            self.voxel_masks = F.pad(voxel_masks, (4, 4, 1, 1, 0, 1))
             if kwargs['voxel_idxs'] is not None:
                 self.voxel_idxs = kwargs['voxel_idxs']
             else:
                 self.voxel_idxs = None
+            # flat index into [subs, X, Y, Z] of the masked voxels (same order as boolean masking), voxel_idxs composed in
+            voxel_flat_idx = torch.nonzero(self.voxel_masks.reshape(-1) == 1).squeeze(1)
+            if self.voxel_idxs is not None:
+                voxel_flat_idx = voxel_flat_idx[torch.as_tensor(self.voxel_idxs, dtype=torch.long)]
+            self.register_buffer('voxel_flat_idx', voxel_flat_idx, persistent=False)
+
+        self.val_corrs = {}
 
         # aux reduction
         self.aux_loss_weights = {}
@@ -176,6 +181,8 @@ class LitModel(LightningModule):
         parser.add_argument('--convtrans_bn', default=False, action="store_true")
         parser.add_argument('--no_convtrans', default=False, action="store_true")
         parser.add_argument('--separate_rois', default=False, action="store_true")
+        parser.add_argument('--fused_neck', default=False, action="store_true",
+                            help='with --separate_rois, run all roi heads as one conv / pooling / bmm per layer')
         # legacy
         parser.add_argument('--fc_batch_norm', default=False, action="store_true")
         parser.add_argument('--global_pooling', default=False, action="store_true")
@@ -184,44 +191,73 @@ class LitModel(LightningModule):
     def on_train_start(self):
         self.logger.log_hyperparams(self.hparams)
 
+    def on_save_checkpoint(self, checkpoint):
+        checkpoint['voxel_idxs'] = None if self.trained_voxel_idxs is None else \
+            np.asarray(self.trained_voxel_idxs).tolist()
+
+    def backbone_frozen(self, epoch=None):
+        """same rule as BackboneFinetuning / HalfScoreFinetuning, decides which dataloaders serve the epoch"""
+        epoch = self.current_epoch if epoch is None else epoch
+        if self.hparams.backbone_freeze_epochs > 0:
+            return epoch < self.hparams.backbone_freeze_epochs
+        if self.hparams.backbone_freeze_score > 0:
+            # one-way: HalfScoreFinetuning never freezes again, a later dip must not bring back the stale features
+            if getattr(self, 'current_val_score', 0.) >= self.hparams.backbone_freeze_score:
+                self.backbone_unfrozen = True
+            return not getattr(self, 'backbone_unfrozen', False)
+        return False
+
+    def on_train_epoch_start(self):
+        frozen = self.backbone_frozen()
+        if not frozen and getattr(self, 'last_backbone_frozen', False):
+            rank_zero_info(f'epoch {self.current_epoch}: backbone unfrozen, training end-to-end')
+        self.last_backbone_frozen = frozen
+        self.log('phase/backbone_frozen', float(frozen), logger=True, on_step=False, on_epoch=True)
+
+    def forward_backbone(self, x_vid):
+        if self.hparams.backbone_type == 'bdcn_edge':
+            # if self.training == False:
+            #     self.logger.experiment.add_image('original', x_vid[0, :, -1, :, :], global_step=self.global_step, dataformats='CHW')
+            # vid to img
+            x_vid = x_vid.permute(0, 2, 1, 3, 4)
+            s = x_vid.shape
+            x_vid = x_vid.reshape(s[0] * s[1], *s[2:])
+
+            out_vid = self.backbone(x_vid)
+
+            # img to vid
+            out_vid = out_vid.reshape(s[0], s[1], s[3], s[4])
+            if self.training == False:
+                self.logger.experiment[0].add_image('edges', F.sigmoid(out_vid[0, -1, :, :]),
+                                                    global_step=self.global_step, dataformats='HW')
+                # self.logger.experiment.add_scalar(f'edges/max', F.sigmoid(self.out_vid[-1][0, -1, :, :]).max(), global_step=self.global_step)
+        elif self.hparams.backbone_type == 'bit':
+            x_vid = x_vid.permute(0, 2, 1, 3, 4)
+            s = x_vid.shape
+            x_vid = x_vid.reshape(s[0] * s[1], *s[2:])
+
+            outs = self.backbone(x_vid)
+            # self.out_vid = {}
+            # for x_i, out in outs.items():
+            #     self.out_vid[x_i] = out.reshape(s[0] * s[1], -1, s[3], s[4]) if x_i != 'x5' else out
+            out_vid = outs
+        elif self.hparams.backbone_type == 'i3d_rgb':
+            out_vid = self.backbone(x_vid)
+        elif self.hparams.backbone_type == 'i3d_flow':
+            # print(x_vid.shape)
+            out_vid = self.backbone(x_vid)
+        else:
+            NotImplementedError()
+        return out_vid
+
     def forward(self, x):
-        if not self.hparams.load_from_np:
-            x_vid = x['video']
-            # x_add = {k: v for k, v in x.items() if k != 'video'}
-
-            if self.hparams.backbone_type == 'bdcn_edge':
-                # if self.training == False:
-                #     self.logger.experiment.add_image('original', x_vid[0, :, -1, :, :], global_step=self.global_step, dataformats='CHW')
-                # vid to img
-                x_vid = x_vid.permute(0, 2, 1, 3, 4)
-                s = x_vid.shape
-                x_vid = x_vid.reshape(s[0] * s[1], *s[2:])
-
-                self.out_vid = self.backbone(x_vid)
-
-                # img to vid
-                self.out_vid = self.out_vid.reshape(s[0], s[1], s[3], s[4])
-                if self.training == False:
-                    self.logger.experiment[0].add_image('edges', F.sigmoid(self.out_vid[0, -1, :, :]),
-                                                        global_step=self.global_step, dataformats='HW')
-                    # self.logger.experiment.add_scalar(f'edges/max', F.sigmoid(self.out_vid[-1][0, -1, :, :]).max(), global_step=self.global_step)
-            elif self.hparams.backbone_type == 'bit':
-                x_vid = x_vid.permute(0, 2, 1, 3, 4)
-                s = x_vid.shape
-                x_vid = x_vid.reshape(s[0] * s[1], *s[2:])
-
-                outs = self.backbone(x_vid)
-                # self.out_vid = {}
-                # for x_i, out in outs.items():
-                #     self.out_vid[x_i] = out.reshape(s[0] * s[1], -1, s[3], s[4]) if x_i != 'x5' else out
-                self.out_vid = outs
-            elif self.hparams.backbone_type == 'i3d_rgb':
-                self.out_vid = self.backbone(x_vid)
-            elif self.hparams.backbone_type == 'i3d_flow':
-                # print(x_vid.shape)
-                self.out_vid = self.backbone(x_vid)
-            else:
-                NotImplementedError()
+        if not self.hparams.load_from_np and 'video' in x:
+            self.out_vid = self.forward_backbone(x['video'])
+        elif not self.hparams.load_from_np:
+            # precomputed backbone features (feature_cache.py), stored per clip
+            if self.hparams.backbone_type == 'bit':
+                x = {k: v.flatten(0, 1) for k, v in x.items()}  # B x T x ... -> frames as batch
+            self.out_vid = x
         else:
             self.out_vid = x
 
@@ -232,8 +268,7 @@ class LitModel(LightningModule):
             assert out_aux is None
             out = out['WB']
             if not self.hparams.no_convtrans:
-                out_voxels = out[self.voxel_masks.unsqueeze(0).expand(out.size()) == 1].reshape(out.shape[0], -1)
-                out_voxels = out_voxels[:, self.voxel_idxs] if self.voxel_idxs is not None else out_voxels
+                out_voxels = out.reshape(out.shape[0], -1).index_select(1, self.voxel_flat_idx)
             else:
                 out_voxels = out
             out = {'WB': out_voxels}
@@ -241,6 +276,14 @@ class LitModel(LightningModule):
 
         return out
 
+    def normalize_input(self, vid):
+        """compact cache batches arrive as uint8 frames / fp16 flow, normalize them here on the device"""
+        if vid.dtype == torch.uint8:
+            vid = normalize_video(vid.float() / 255, self.hparams.preprocessing_type, channel_dim=1)
+        elif vid.dtype == torch.float16:
+            vid = vid.float()
+        return vid
+
     def _shared_train_val(self, batch, batch_idx, prefix, is_log=True):
         x, y = batch
         if self.hparams['track'] == 'mini_track':
@@ -314,8 +357,11 @@ class LitModel(LightningModule):
         if self.hparams.freeze_bn:
             self.backbone.apply(disable_bn)
         x, y = batch
+        aug = x.pop('aug', None)
         if 'video' in x.keys():
+            x['video'] = self.normalize_input(x['video'])
             x['video'] = self.train_transform(x['video']) if self.train_transform is not None else x['video']
+            x['video'] = self.augmentation(x['video'], aug) if aug is not None else x['video']
         batch = (x, y)
 
         out, loss, _ = self._shared_train_val(batch, batch_idx, 'train')
@@ -345,69 +391,88 @@ class LitModel(LightningModule):
 
     def validation_step(self, batch, batch_idx):
         x, y = batch
+        x.pop('aug', None)
         if 'video' in x.keys():
+            x['video'] = self.normalize_input(x['video'])
             x['video'] = self.test_transform(x['video']) if self.test_transform is not None else x['video']
         batch = (x, y)
         out, loss, out_aux = self._shared_train_val(batch, batch_idx, 'val')
         y = batch[-1]
         # self.val_corr(out[:, 0], y[:, 0])
-        return {'out': out, 'y': y, 'out_aux': out_aux}
+        self.update_val_corrs(out, y, out_aux)
+
+    def val_corr(self, k):
+        if k not in self.val_corrs:
+            self.val_corrs[k] = StreamingCorrelation()
+        return self.val_corrs[k]
+
+    def update_val_corrs(self, out, y, out_aux):
+        """running sums instead of keeping every val output until validation_epoch_end"""
+        if self.hparams.separate_rois:
+            for roi, yy in zip(self.rois, dokodemo_hsplit(y, self.hparams.idx_ends)):
+                self.val_corr(roi).update(out[roi], yy)
+                if out_aux is not None:
+                    for k, v in out_aux.items():
+                        if k.startswith(f'{roi}_'):
+                            self.val_corr(k).update(v, yy)
+        else:
+            self.val_corr(self.hparams.rois).update(out[self.hparams.rois], y)
+
+    def on_validation_epoch_start(self):
+        self.val_corrs = {}
 
     def predict_step(self, batch: Any, batch_idx: int, dataloader_idx: Optional[int] = None) -> Any:
-        x = batch
+        x = batch[0] if isinstance(batch, (tuple, list)) else batch  # val loaders also yield fmri
+        x.pop('aug', None)
         if 'video' in x.keys():
+            x['video'] = self.normalize_input(x['video'])
             x['video'] = self.test_transform(x['video']) if self.test_transform is not None else x['video']
         return self(x)
 
     def validation_epoch_end(self, val_step_outputs) -> None:
-        val_ys = torch.cat([out['y'] for out in val_step_outputs], 0)
+        # every score stays on the device until the single .tolist() below
+        names, scores = [], []
+        if self.hparams.separate_rois:
+            for k, acc in self.val_corrs.items():
+                names.append(k)
+                scores.append(acc.compute().mean()[None])
+            scores = dict(zip(names, torch.cat(scores).tolist()))
+        else:
+            # per subject only over all voxels, sub_idx_ends is None for voxel subsets
+            subs = [f'sub{i + 1:02d}' for i in range(10)] if self.hparams.subs == 'all' \
+                else self.hparams.subs.split(',')
+            scores = roi_scores(self.val_corrs[self.hparams.rois].compute(), self.hparams.rois.split(','),
+                                self.hparams.idx_ends, voxel_idxs=self.trained_voxel_idxs, subs=subs,
+                                sub_idx_ends=self.hparams.get('sub_idx_ends'))
+        self.val_corrs = {}
+
         avg_val_corr = []
         if self.hparams.separate_rois:
-            for roi, yy in zip(self.rois, dokodemo_hsplit(val_ys, self.hparams.idx_ends)):
-                val_outs = torch.cat([out['out'][roi] for out in val_step_outputs], 0)
-                val_corr = vectorized_correlation(val_outs, yy).mean().item()
+            for roi in self.rois:
+                val_corr = scores[roi]
                 avg_val_corr.append(val_corr)
                 # print(val_corr.mean())
                 self.log(f'val_corr/{roi}_final', val_corr, prog_bar=True, logger=True, sync_dist=False)
 
                 # aux heads
-                if val_step_outputs[0]['out_aux'] is not None:
-                    keys = val_step_outputs[0]['out_aux'].keys()
-                    for k in keys:
-                        if roi not in k: continue
-                        outs = []
-                        for i, val_step_output in enumerate(val_step_outputs):
-                            out_aux = val_step_output['out_aux']
-                            outs.append(out_aux[k])
-                        outs = torch.cat(outs, 0)
-                        corr = vectorized_correlation(outs, yy).mean().item()
-
-                        self.log(f'aux_lw/{k}', self.aux_loss_weights[k], prog_bar=False, logger=True, sync_dist=True)
-                        self.log(f'val_corr/{k}', corr, logger=True, sync_dist=False)
+                for k in names:
+                    if not k.startswith(f'{roi}_'): continue
+                    self.log(f'aux_lw/{k}', self.aux_loss_weights[k], prog_bar=False, logger=True, sync_dist=True)
+                    self.log(f'val_corr/{k}', scores[k], logger=True, sync_dist=False)
         else:
             # Logger.current_logger().report_scalar(
             #     "validation", "correlation", iteration=self.global_step, value=val_corr)
-            def roi_correlation(x, y, roi_lens, roi_names):
-                xx = dokodemo_hsplit(x, roi_lens)
-                yy = dokodemo_hsplit(y, roi_lens)
-
-                corrs_dict = {}
-                i = 0
-                for roi in roi_names:
-                    a, b = xx[i], yy[i]
-                    corr = vectorized_correlation(a, b).mean().item()
-                    corrs_dict[roi] = corr
-                    i += 1
-
-                return corrs_dict
-
-            val_outs = torch.cat([out['out'][self.hparams.rois] for out in val_step_outputs], 0)
-            for roi, corr in roi_correlation(val_outs.to(self.device), val_ys.to(self.device), self.hparams.idx_ends,
-                                             self.hparams.rois.split(',')).items():
+            rois = self.hparams.rois.split(',')
+            for roi in rois:
+                if roi not in scores:  # no voxel of it in voxel_idxs
+                    continue
+                corr = scores[roi]
                 self.log(f'val_corr/{roi}_final', corr, logger=True, sync_dist=False)
                 avg_val_corr.append(corr)
                 if roi == 'WB': # dirty finetune callback
                     self.current_val_score = corr
+            for k in [k for k in scores if k not in rois]:  # per subject
+                self.log(f'val_corr/{k}', scores[k], logger=True, sync_dist=False)
 
         avg_val_corr = np.mean(avg_val_corr)
         self.log(f'val_corr/final', avg_val_corr, prog_bar=True, logger=True, sync_dist=False)
@@ -458,6 +523,89 @@ class LitModel(LightningModule):
         return tuple_of_dicts
 
 
+def build_datamodule(args, voxel_idxs=None, **kwargs):
+    dm_kwargs = dict(batch_size=args.batch_size, datasets_dir=args.datasets_dir, rois=args.rois,
+                     num_frames=args.video_frames, resolution=args.video_size, track=args.track,
+                     cached=args.cached, val_ratio=args.val_ratio,
+                     random_split=args.val_random_split,
+                     use_cv=args.use_cv, num_split=int(1 / args.val_ratio), fold=args.fold,
+                     additional_features_dir=args.additional_features_dir,
+                     additional_features=args.additional_features,
+                     preprocessing_type=args.preprocessing_type,
+                     load_from_np=args.load_from_np,
+                     voxel_idxs=voxel_idxs,
+                     consolidated=args.consolidated_cache,
+                     compact=args.compact_cache,
+                     num_workers=args.num_workers,
+                     preload_ram_gb=args.preload_ram_gb,
+                     gpu_resident=args.gpu_resident,
+                     crop_size=args.crop_size,
+                     random_crop=args.random_crop,
+                     augment=args.augment,
+                     augment_degrees=args.rotation_degrees,
+                     augment_seed=args.augment_seed,
+                     pyramid=args.pyramid,
+                     pyramid_budget_gb=args.pyramid_budget_gb)
+    dm_kwargs.update(kwargs)
+    return AlgonautsDataModule(**dm_kwargs)
+
+
+def prediction_index(hparams, dm, voxel_idxs=None):
+    """column layout of a run's predictions, see prediction_store.save_predictions"""
+    rois = hparams['rois'].split(',')
+    starts = [0] + list(dm.idx_ends[:-1])
+    roi_ranges = {roi: [int(s), int(e)] for roi, s, e in zip(rois, starts, dm.idx_ends)}
+    roi_sizes = {roi: e - s for roi, (s, e) in roi_ranges.items()}
+    sub_ranges = {}
+    if hparams['track'] == 'full_track':
+        roi_sizes['WB'] = int(dm.sub_idx_ends[-1])  # voxel_idxs only select from it
+        sub_starts = [0] + list(dm.sub_idx_ends[:-1])
+        sub_ranges['WB'] = {sub: [int(s), int(e)] for sub, s, e in
+                            zip(dm.algonauts_full.subs, sub_starts, dm.sub_idx_ends)}
+    elif os.path.exists(os.path.join(hparams['datasets_dir'], 'config.json')):
+        with open(os.path.join(hparams['datasets_dir'], 'config.json')) as f:
+            roi_sub_lens = json.load(f)  # written by preprocess_data.write_targets
+        subs = [f'sub{i + 1:02d}' for i in range(10)]
+        for roi in rois:
+            sub_ends = np.cumsum(roi_sub_lens[roi]).tolist()
+            sub_ranges[roi] = {sub: [s, e] for sub, s, e in zip(subs, [0] + sub_ends[:-1], sub_ends)}
+    return {'task_id': task.id, 'model_key': model_key(hparams), 'fold': hparams['fold'],
+            'track': hparams['track'], 'backbone_type': hparams['backbone_type'], 'tag': hparams['tag'],
+            'rois': rois, 'roi_ranges': roi_ranges, 'roi_sizes': roi_sizes, 'sub_ranges': sub_ranges}
+
+
+def checkpoint_voxel_idxs(ckpt):
+    """voxel_idxs a checkpoint was trained on, None for all voxels"""
+    if 'voxel_idxs' in ckpt:
+        return None if ckpt['voxel_idxs'] is None else np.asarray(ckpt['voxel_idxs'])
+    # checkpoints from before voxel_idxs were saved, a subset can be detected but not recovered
+    hparams = ckpt['hyper_parameters']
+    if hparams['track'] == 'full_track':
+        subset = hparams.get('sub_idx_ends') is None
+    else:
+        subset = hparams['output_size'] != hparams['idx_ends'][-1]
+    if subset:
+        raise NotImplementedError('checkpoint trained on a voxel subset that it does not record')
+    return None
+
+
+def build_backbone(hparams):
+    if hparams['backbone_type'] == 'i3d_rgb':
+        backbone = modify_resnets_patrial_x_all(multi_resnet3d50(cache_dir=hparams['i3d_rgb_dir'],
+                                                                 pretrained=hparams['pretrained']))
+    elif hparams['backbone_type'] == 'bdcn_edge':
+        backbone = load_bdcn(hparams['bdcn_path'], pretrained=hparams['pretrained'])
+    elif hparams['backbone_type'] == 'i3d_flow':
+        backbone = load_i3d_flow(hparams['i3d_flow_path'], pretrained=hparams['pretrained'])
+    elif hparams['backbone_type'] == 'vggish':
+        backbone = nn.Module()
+    elif hparams['backbone_type'] == 'bit':
+        backbone = load_bit(hparams['bit_path'])
+    else:
+        NotImplementedError()
+    return backbone
+
+
 def train(args, voxel_idxs=None, level: str = ''):
     hparams = vars(args)
     # if voxel_idxs is not None:
@@ -466,16 +614,7 @@ def train(args, voxel_idxs=None, level: str = ''):
     # if args.backbone_type == 'i3d_flow':
     #     assert args.load_from_np
 
-    dm = AlgonautsDataModule(batch_size=args.batch_size, datasets_dir=args.datasets_dir, rois=args.rois,
-                             num_frames=args.video_frames, resolution=args.video_size, track=args.track,
-                             cached=args.cached, val_ratio=args.val_ratio,
-                             random_split=args.val_random_split,
-                             use_cv=args.use_cv, num_split=int(1 / args.val_ratio), fold=args.fold,
-                             additional_features_dir=args.additional_features_dir,
-                             additional_features=args.additional_features,
-                             preprocessing_type=args.preprocessing_type,
-                             load_from_np=args.load_from_np,
-                             voxel_idxs=voxel_idxs)
+    dm = build_datamodule(args, voxel_idxs)
     dm.setup()
 
     callbacks = []
@@ -489,16 +628,20 @@ def train(args, voxel_idxs=None, level: str = ''):
     )
     callbacks.append(early_stop_callback)
 
+    # cached features come from the backbone in eval mode, its batch norm stays as it was when they were extracted
+    train_bn = not args.backbone_features_dir
     if args.backbone_freeze_epochs > 0:
         assert args.backbone_freeze_score == 0
         finetune_callback = BackboneFinetuning(
-            args.backbone_freeze_epochs if not args.debug else 1
+            args.backbone_freeze_epochs if not args.debug else 1,
+            train_bn=train_bn
         )
         callbacks.append(finetune_callback)
     if args.backbone_freeze_score > 0:
         assert args.backbone_freeze_epochs == 0
         finetune_callback = HalfScoreFinetuning(
-            args.backbone_freeze_score
+            args.backbone_freeze_score,
+            train_bn=train_bn
         )
         callbacks.append(finetune_callback)
 
@@ -534,18 +677,7 @@ def train(args, voxel_idxs=None, level: str = ''):
     if args.debug:
         torch.set_printoptions(10)
 
-    if args.backbone_type == 'i3d_rgb':
-        backbone = modify_resnets_patrial_x_all(multi_resnet3d50(cache_dir=args.i3d_rgb_dir, pretrained=args.pretrained))
-    elif args.backbone_type == 'bdcn_edge':
-        backbone = load_bdcn(args.bdcn_path, pretrained=args.pretrained)
-    elif args.backbone_type == 'i3d_flow':
-        backbone = load_i3d_flow(args.i3d_flow_path, pretrained=args.pretrained)
-    elif args.backbone_type == 'vggish':
-        backbone = nn.Module()
-    elif args.backbone_type == 'bit':
-        backbone = load_bit(args.bit_path)
-    else:
-        NotImplementedError()
+    backbone = build_backbone(hparams)
 
     tb_logger = pl_loggers.TensorBoardLogger(os.path.join(args.logs_dir, 'lightning_logs', task.id))
     csv_logger = pl_loggers.CSVLogger(os.path.join(args.logs_dir, 'csv_logs', task.id))
@@ -565,6 +697,8 @@ def train(args, voxel_idxs=None, level: str = ''):
         val_check_interval=args.val_check_interval if not args.debug else 1.0,
         callbacks=callbacks,
         logger=loggers,
+        # the frozen phase is served from cached features, swap loaders when the backbone unfreezes
+        reload_dataloaders_every_n_epochs=1 if args.backbone_features_dir else 0,
         # auto_lr_find=True,
         # auto_scale_batch_size='binsearch'  # useful?
         # track_grad_norm=2,
@@ -572,17 +706,30 @@ def train(args, voxel_idxs=None, level: str = ''):
 
     hparams['output_size'] = dm.num_voxels
     hparams['idx_ends'] = dm.idx_ends
+    # per subject voxel boundaries, only meaningful over all voxels
+    hparams['sub_idx_ends'] = dm.sub_idx_ends if voxel_idxs is None else None
     z = np.array(dm.idx_ends).copy()
     z[1:] -= z[:-1].copy()
     hparams['roi_lens'] = z.tolist()
 
-    if args.predictions_dir:
-        prediction_dir = os.path.join(args.predictions_dir, task.id)
-        if not os.path.exists(prediction_dir):
-            os.system(f'mkdir {prediction_dir}')
-
     plmodel = LitModel(backbone, hparams, voxel_idxs=voxel_idxs)
 
+    if args.backbone_features_dir and (args.backbone_freeze_epochs > 0 or args.backbone_freeze_score > 0):
+        # two-phase training: the neck trains on cached backbone outputs until the finetune callback unfreezes
+        features_dir = extract_features(plmodel, dm.test_dataset, args.backbone_features_dir,
+                                        device=extraction_device(args))
+        dm.attach_features(features_dir, args.pyramid_layers.split(','),
+                           batch_size=args.feature_batch_size or args.batch_size,
+                           predict=args.backbone_freeze_score == 0 and args.backbone_freeze_epochs >= args.max_epochs)
+
+    # teardown('fit') at the end of fit drops the datasets the prediction layout is read from
+    index = prediction_index(hparams, dm, voxel_idxs) if args.save_checkpoints and args.predictions_dir else None
+    if args.save_checkpoints:
+        # val split and its fmri for the out-of-fold predictions, same teardown
+        val_dataset = dm.val_dataset
+        oof_rows = np.asarray(val_dataset.indices)
+        oof_y = dm.algonauts_full.fmris[torch.as_tensor(oof_rows)].float()  # voxel_idxs columns already
+
     trainer.fit(plmodel, datamodule=dm)
 
     # dm.teardown()
@@ -595,37 +742,28 @@ def train(args, voxel_idxs=None, level: str = ''):
         if args.rm_checkpoints:
             os.remove(checkpoint_callback.best_model_path)  # we are working on a 256GB SSD, tasuketekure
 
-        for roi in rois:  # roi maybe multiple
-            prediction = torch.cat([p[0][roi] for p in predictions], 0).cpu()
-            if (not hparams['separate_rois']) and (len(hparams['rois'].split(',')) > 1):  # for bdcn_edge multi rois
-                for rroi, pred in zip(hparams['rois'].split(','),
-                                      dokodemo_hsplit(prediction, hparams['idx_ends'])):  # roi is single
-                    # print(pred.shape)
-                    torch.save(pred, os.path.join(prediction_dir, f'{rroi}.pt'))
-            else:
-                # if voxel_idxs is None:
-                torch.save(prediction, os.path.join(prediction_dir, f'{roi}.pt'))
-                # else:  # for WB sub divide
-                #     if not args.debug:
-                #         torch.save(prediction, os.path.join(prediction_dir, f'{roi}_{level}.pt'))
-                #     torch.save(voxel_idxs, os.path.join(prediction_dir, f'{roi}_voxel_idxs_{level}.pt'))
-                #
-                #     dm = AlgonautsDataModule(batch_size=args.batch_size, datasets_dir=args.datasets_dir, rois=args.rois,
-                #                              num_frames=args.video_frames, resolution=args.video_size, track=args.track,
-                #                              cached=args.cached, val_ratio=args.val_ratio,
-                #                              random_split=args.val_random_split,
-                #                              use_cv=args.use_cv, num_split=int(1 / args.val_ratio), fold=args.fold,
-                #                              additional_features_dir=args.additional_features_dir,
-                #                              additional_features=args.additional_features,
-                #                              preprocessing_type=args.preprocessing_type,
-                #                              load_from_np=args.load_from_np,
-                #                              voxel_idxs=voxel_idxs)
-                #     dm.setup('fit')
-                #     assert args.fold == -1 and args.val_ratio == 0.1
-                #     outs = prediction[900:1000]
-                #     ys = torch.cat([data[1] for data in dm.val_dataloader()], 0)
-                #     voxel_corrs = vectorized_correlation(outs, ys).cpu()
-                #     return voxel_corrs
+        # out-of-fold predictions of the val clips, for the per voxel val corr and stacking.py
+        oof = trainer.predict(plmodel, dataloaders=dm.eval_dataloader(val_dataset))
+        oof = torch.cat([torch.cat([p[0][roi] for p in oof], 0) for roi in rois], -1).float().cpu()
+        val_corr = vectorized_correlation(oof, oof_y)
+
+        # one memmappable [clips, voxels] array per run, see prediction_store.py for the aggregation cli
+        prediction = torch.cat([torch.cat([p[0][roi] for p in predictions], 0) for roi in rois], -1)
+        if args.predictions_dir:
+            prediction_dir = os.path.join(args.predictions_dir, task.id)
+            if args.save_roi_pt:  # the old per roi torch.save files, next to the store
+                os.makedirs(prediction_dir, exist_ok=True)
+                for roi in rois:
+                    roi_prediction = torch.cat([p[0][roi] for p in predictions], 0).cpu()
+                    if not hparams['separate_rois'] and len(hparams['rois'].split(',')) > 1:  # bdcn_edge multi rois
+                        for rroi, pred in zip(hparams['rois'].split(','),
+                                              dokodemo_hsplit(roi_prediction, hparams['idx_ends'])):
+                            torch.save(pred, os.path.join(prediction_dir, f'{rroi}.pt'))
+                    else:
+                        torch.save(roi_prediction, os.path.join(prediction_dir, f'{roi}.pt'))
+            save_predictions(prediction_dir, prediction.float().cpu().numpy(), index, val_corr=val_corr.numpy(),
+                             voxel_idxs=voxel_idxs, oof=oof.numpy(), oof_rows=oof_rows)
+        return val_corr
 
 
 def parse_args():
@@ -634,6 +772,10 @@ def parse_args():
     parser.add_argument('--video_size', type=int, default=288)
     parser.add_argument('--crop_size', type=int, default=0)
     parser.add_argument('--random_crop', default=False, action="store_true")
+    parser.add_argument('--augment', default=False, action="store_true",
+                        help='random horizontal flip and in-plane rotation of train clips, on the gpu')
+    parser.add_argument('--rotation_degrees', type=float, default=15.)
+    parser.add_argument('--augment_seed', type=int, default=0, help='seeds random crops, augmentation and order')
     parser.add_argument('--batch_size', type=int, default=8)
     parser.add_argument('--accumulate_grad_batches', type=int, default=1)
     parser.add_argument('--max_epochs', type=int, default=300)
@@ -667,6 +809,15 @@ def parse_args():
     parser.add_argument('--val_ratio', type=float, default=0.1)
     parser.add_argument('--val_random_split', default=False, action="store_true")
     parser.add_argument('--load_from_np', default=False, action="store_true")
+    parser.add_argument('--backbone_features_dir', type=str, default='',
+                        help='cache backbone outputs here, train the neck on them while the backbone is frozen. '
+                             'features are extracted once from center (--crop_size) clips without augmentation, '
+                             '--random_crop / --augment only apply once the backbone is unfrozen. '
+                             'batch norm of the backbone is not trained (train_bn=False)')
+    parser.add_argument('--feature_batch_size', type=int, default=0,
+                        help='batch size of the cached feature phase, 0 for --batch_size')
+    parser.add_argument('--gpu_resident', default=False, action="store_true",
+                        help='with --load_from_np, keep all features and fmri on the gpu, no DataLoader workers')
     parser.add_argument('--save_checkpoints', default=False, action="store_true")
     parser.add_argument('--use_cv', default=False, action="store_true")
     parser.add_argument('--fold', type=int, default=-1)
@@ -674,10 +825,25 @@ def parse_args():
     parser.add_argument('--preprocessing_type', type=str, default='mmit', help='mmit, bdcn, i3d_flow, bit')
     parser.add_argument('--early_stop_epochs', type=int, default=10)
     parser.add_argument('--cached', default=False, action="store_true")
+    parser.add_argument('--consolidated_cache', default=False, action="store_true",
+                        help='read clips from one memmapped [N, C, T, H, W] store')
+    parser.add_argument('--compact_cache', default=False, action="store_true",
+                        help='cache uint8 frames (fp16 flow), normalized on the gpu')
+    parser.add_argument('--pyramid', type=str, default='',
+                        help='{resolution}_{frames} master clip cache, e.g. 288_64, smaller sizes / frame counts '
+                             'are derived from it instead of decoding the mp4s')
+    parser.add_argument('--pyramid_budget_gb', type=float, default=100.,
+                        help='disk budget of the derived sizes, least recently used are removed')
+    parser.add_argument('--preload_ram_gb', type=float, default=0.,
+                        help='preload all clips into shared memory if they fit this budget (loads in the main '
+                             'process, num_workers=0), 0 to disable')
+    parser.add_argument('--num_workers', type=int, default=8)
     parser.add_argument("--fp16", default=False, action="store_true")
     parser.add_argument("--asm", default=False, action="store_true")
     parser.add_argument("--debug", default=False, action="store_true")
     parser.add_argument('--predictions_dir', type=str, default='/data_smr/huze/projects/my_algonauts/predictions/')
+    parser.add_argument('--save_roi_pt', default=False, action="store_true",
+                        help='also write the per roi {roi}.pt predictions of older runs')
     parser.add_argument('--checkpoints_dir', type=str, default='/home/huze/checkpoints/')
     parser.add_argument('--rm_checkpoints', default=False, action="store_true")
     parser.add_argument('--logs_dir', type=str, default='/data_smr/huze/projects/my_algonauts/')
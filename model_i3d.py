@@ -575,28 +575,36 @@ class I3d_neck(nn.Module):
                     num_voxels=output_size, num_chs=self.num_chs,
                     fusion_type=hparams['final_fusion'], detach=hparams['detach_aux'])})
 
+        # rois share the feature map, run them as one conv / pooling / bmm per layer, same parameters as per key
+        self.fused = hparams.get('fused_neck', False) and len(self.rois) > 1 and not self.is_pyramid \
+                     and not self.old_mix and not hparams.get('fc_batch_norm') and 'x5' not in self.pyramid_layers \
+                     and not (self.hparams['track'] == 'full_track' and not self.hparams['no_convtrans'])
+
     def forward(self, x):
 
         # if self.is_x_label:
         #     x_label = x['x_label']
 
-        # vid
-        out = {}
-        for roi in self.rois:
-            for x_i in self.pyramid_layers:
-                for pathway in self.pathways:
-                    k = f'{roi}_{pathway}_{x_i}'
-                    out[k] = x[x_i].clone()
-        x = out
-        # x = {f'{pathway}_{x_i}': x[x_i] for x_i in self.pyramid_layers for pathway in self.pathways}
-        x = {k: self.first_convs[k](v) for k, v in x.items()}
-        self.x_npooled = x
-        if self.is_pyramid:
-            x = self.pyramid_pathway(x, self.pyramid_layers, self.pathways)
-        x = {k: self.poolings[k](v) for k, v in x.items()}
-        self.x_pooled = x
-        # fmri
-        x = {k: self.ch_response[k](v) for k, v in x.items()}
+        if self.fused:
+            x = self.fused_forward(x)
+        else:
+            # vid
+            out = {}
+            for roi in self.rois:
+                for x_i in self.pyramid_layers:
+                    for pathway in self.pathways:
+                        k = f'{roi}_{pathway}_{x_i}'
+                        out[k] = x[x_i].clone()
+            x = out
+            # x = {f'{pathway}_{x_i}': x[x_i] for x_i in self.pyramid_layers for pathway in self.pathways}
+            x = {k: self.first_convs[k](v) for k, v in x.items()}
+            self.x_npooled = x
+            if self.is_pyramid:
+                x = self.pyramid_pathway(x, self.pyramid_layers, self.pathways)
+            x = {k: self.poolings[k](v) for k, v in x.items()}
+            self.x_pooled = x
+            # fmri
+            x = {k: self.ch_response[k](v) for k, v in x.items()}
         # print(self.ch_response)
         # print(self.final_fusions)
 
@@ -622,6 +630,39 @@ class I3d_neck(nn.Module):
 
         return out, out_aux
 
+    def fused_forward(self, x):
+        """first_convs -> poolings -> ch_response for all rois at once, keyed like the per-key path"""
+        self.x_npooled, self.x_pooled, out = {}, {}, {}
+        num_rois = len(self.rois)
+        for x_i in self.pyramid_layers:
+            for pathway in self.pathways:
+                keys = [f'{roi}_{pathway}_{x_i}' for roi in self.rois]
+                convs = [self.first_convs[k] for k in keys]
+                # one 1x1 conv with the per-roi filters stacked: B x (R * planes) x T x H x W
+                v = F.conv3d(x[x_i], torch.cat([c.weight for c in convs], 0), torch.cat([c.bias for c in convs], 0))
+                self.x_npooled.update(zip(keys, v.chunk(num_rois, 1)))
+
+                # rois folded into the batch, the pooling modules are identical across rois
+                v = v.reshape(v.shape[0] * num_rois, self.planes, *v.shape[2:])
+                v = self.poolings[keys[0]](v)
+                v = v.reshape(-1, num_rois, v.shape[-1]).transpose(0, 1)  # R x B x D
+                self.x_pooled.update(zip(keys, v.unbind(0)))
+
+                heads = [self.ch_response[k] for k in keys]
+                for j, layer in enumerate(heads[0]):
+                    if isinstance(layer, nn.Linear):
+                        linears = [h[j] for h in heads]
+                        out_dim = max(l.out_features for l in linears)
+                        # last layers differ in voxel count, zero-pad them to the largest roi
+                        weight = torch.stack([F.pad(l.weight, [0, 0, 0, out_dim - l.out_features]) for l in linears])
+                        bias = torch.stack([F.pad(l.bias, [0, out_dim - l.out_features]) for l in linears])
+                        v = torch.baddbmm(bias.unsqueeze(1), v, weight.transpose(1, 2))
+                    else:  # activation / dropout, elementwise
+                        v = layer(v)
+                out.update({k: v[r, :, :size] for r, (k, size) in enumerate(zip(keys, self.output_sizes))})
+        return {f'{roi}_{pathway}_{x_i}': out[f'{roi}_{pathway}_{x_i}']
+                for roi in self.rois for x_i in self.pyramid_layers for pathway in self.pathways}
+
     def pyramid_pathway(self, x, layers, pathways):
         for roi in self.rois:
             for pathway in pathways:
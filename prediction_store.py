@@ -0,0 +1,219 @@
+import os
+import json
+import glob
+import pickle
+import hashlib
+from argparse import ArgumentParser
+from collections import OrderedDict
+
+import numpy as np
+from tqdm import tqdm
+
+from utils import atomic_save_json, atomic_save_npy
+
+INDEX_FILE = 'index.json'
+PREDICTIONS_FILE = 'predictions.npy'
+VAL_CORR_FILE = 'val_corr.npy'
+VOXEL_IDXS_FILE = 'voxel_idxs.npy'
+OOF_FILE = 'oof.npy'
+OOF_ROWS_FILE = 'oof_rows.npy'
+
+# hparams that differ between folds / machines of the same model
+MODEL_KEY_IGNORE = ['fold', 'gpus', 'num_workers', 'debug', 'predictions_dir', 'checkpoints_dir', 'logs_dir',
+                    'rm_checkpoints', 'save_checkpoints', 'output_size', 'idx_ends', 'sub_idx_ends', 'roi_lens',
+                    'pyramid_budget_gb']
+
+
+def model_key(hparams):
+    """same key for the folds of one model"""
+    config = {k: v for k, v in hparams.items() if k not in MODEL_KEY_IGNORE}
+    return hashlib.sha1(json.dumps(config, sort_keys=True, default=str).encode()).hexdigest()[:16]
+
+
+def save_predictions(run_dir, predictions, index, val_corr=None, voxel_idxs=None, oof=None, oof_rows=None):
+    """one run: [clips, voxels] predictions, per voxel val corr, index.json written last marks it complete
+
+    index needs 'rois' and 'roi_ranges' ({roi: [start, end]} columns of predictions), 'roi_sizes' ({roi: voxels of
+    the whole roi}) and optionally 'sub_ranges' ({roi: {sub: [start, end]}} within the whole roi).
+    With voxel_idxs the run only covers those voxels of its (single) roi.
+    oof are the [val clips, voxels] predictions of the held out (fold's) train clips oof_rows, for stacking.
+    """
+    os.makedirs(run_dir, exist_ok=True)
+    predictions = np.asarray(predictions, dtype=np.float32)
+    atomic_save_npy(os.path.join(run_dir, PREDICTIONS_FILE), predictions)
+    if val_corr is not None:
+        atomic_save_npy(os.path.join(run_dir, VAL_CORR_FILE), np.asarray(val_corr, dtype=np.float32))
+    if voxel_idxs is not None:
+        assert len(index['rois']) == 1
+        atomic_save_npy(os.path.join(run_dir, VOXEL_IDXS_FILE), np.asarray(voxel_idxs, dtype=np.int64))
+    if oof is not None:
+        atomic_save_npy(os.path.join(run_dir, OOF_FILE), np.asarray(oof, dtype=np.float32))
+        atomic_save_npy(os.path.join(run_dir, OOF_ROWS_FILE), np.asarray(oof_rows, dtype=np.int64))
+    index = dict(index, num_clips=predictions.shape[0], num_voxels=predictions.shape[1],
+                 val_corr=val_corr is not None, voxel_idxs=voxel_idxs is not None, oof=oof is not None)
+    atomic_save_json(os.path.join(run_dir, INDEX_FILE), index)
+
+
+class PredictionStore(object):
+    """memmapped read access to one run written by save_predictions"""
+
+    def __init__(self, run_dir):
+        self.run_dir = run_dir
+        with open(os.path.join(run_dir, INDEX_FILE)) as f:
+            self.index = json.load(f)
+        self.predictions = np.load(os.path.join(run_dir, PREDICTIONS_FILE), mmap_mode='r')
+        self.val_corr = np.load(os.path.join(run_dir, VAL_CORR_FILE), mmap_mode='r') \
+            if self.index['val_corr'] else None
+        self.voxel_idxs = np.load(os.path.join(run_dir, VOXEL_IDXS_FILE)) if self.index['voxel_idxs'] else None
+        self.oof = np.load(os.path.join(run_dir, OOF_FILE), mmap_mode='r') if self.index.get('oof') else None
+        self.oof_rows = np.load(os.path.join(run_dir, OOF_ROWS_FILE)) if self.index.get('oof') else None
+        if self.voxel_idxs is not None:  # not necessarily sorted
+            self.voxel_order = np.argsort(self.voxel_idxs)
+            self.sorted_voxel_idxs = self.voxel_idxs[self.voxel_order]
+
+    @property
+    def rois(self):
+        return self.index['rois']
+
+    def roi_columns(self, roi, start, end):
+        """columns of this run holding voxels [start, end) of roi, and where they go within that block"""
+        run_start, run_end = self.index['roi_ranges'][roi]
+        if self.voxel_idxs is None:
+            return slice(run_start + start, run_start + end), slice(0, end - start)
+        lo, hi = np.searchsorted(self.sorted_voxel_idxs, [start, end])
+        return run_start + self.voxel_order[lo:hi], self.sorted_voxel_idxs[lo:hi] - start
+
+
+def find_runs(paths):
+    run_dirs = []
+    for p in paths:
+        if os.path.exists(os.path.join(p, INDEX_FILE)):
+            run_dirs.append(p)
+        else:
+            run_dirs += sorted(os.path.dirname(f) for f in glob.glob(os.path.join(p, '*', INDEX_FILE)))
+    return run_dirs
+
+
+def voxel_weights(corr, power):
+    return np.clip(np.nan_to_num(corr), 0, None) ** power
+
+
+def aggregate(stores, output_dir, weighting='mean', power=1., block_voxels=8192, group_folds=True):
+    """fold average per model, then an (optionally val corr weighted) average over models, block by block
+
+    Memory stays at a few [clips, block_voxels] arrays. Voxels without any positive weight fall back to the plain
+    model average, voxels no run covers are nan.
+    """
+    num_clips = stores[0].index['num_clips']
+    assert all(s.index['num_clips'] == num_clips for s in stores), 'runs predicted different clips'
+    roi_sizes, sub_ranges = OrderedDict(), {}
+    for s in stores:
+        for roi in s.rois:
+            size = s.index['roi_sizes'][roi]
+            assert roi_sizes.setdefault(roi, size) == size, f'{roi} has {size} != {roi_sizes[roi]} voxels'
+            if (s.index.get('sub_ranges') or {}).get(roi):
+                sub_ranges[roi] = s.index['sub_ranges'][roi]
+    if weighting == 'val_corr':
+        missing = [s.run_dir for s in stores if s.val_corr is None]
+        assert not missing, f'no val corr for {missing}'
+
+    groups = OrderedDict()
+    for s in stores:
+        groups.setdefault(s.index['model_key'] if group_folds else s.run_dir, []).append(s)
+
+    roi_ranges = OrderedDict()
+    offset = 0
+    for roi, size in roi_sizes.items():
+        roi_ranges[roi] = [offset, offset + size]
+        offset += size
+    os.makedirs(output_dir, exist_ok=True)
+    tmp_path = os.path.join(output_dir, f'{PREDICTIONS_FILE}.tmp{os.getpid()}')
+    out = np.lib.format.open_memmap(tmp_path, mode='w+', dtype=np.float32, shape=(num_clips, offset))
+    out_corr = np.full(offset, np.nan, dtype=np.float32)
+
+    for roi, size in roi_sizes.items():
+        roi_groups = [[s for s in runs if roi in s.rois] for runs in groups.values()]
+        roi_groups = [runs for runs in roi_groups if runs]
+        for start in tqdm(range(0, size, block_voxels), desc=f'{roi}, {len(roi_groups)} models'):
+            end = min(start + block_voxels, size)
+            num = np.zeros((num_clips, end - start))
+            den = np.zeros(end - start)
+            num_uniform = np.zeros((num_clips, end - start))
+            den_uniform = np.zeros(end - start)
+            corr_sum = np.zeros(end - start)
+            for runs in roi_groups:
+                fold_sum = np.zeros((num_clips, end - start))
+                fold_count = np.zeros(end - start)
+                fold_corr = np.zeros(end - start)
+                for s in runs:
+                    cols, dst = s.roi_columns(roi, start, end)
+                    fold_sum[:, dst] += s.predictions[:, cols]
+                    fold_count[dst] += 1
+                    if s.val_corr is not None:
+                        fold_corr[dst] += np.nan_to_num(s.val_corr[cols])
+                covered = fold_count > 0
+                fold_mean = fold_sum[:, covered] / fold_count[covered]
+                corr = fold_corr[covered] / fold_count[covered]
+                w = voxel_weights(corr, power) if weighting == 'val_corr' else np.ones(covered.sum())
+                num[:, covered] += w * fold_mean
+                den[covered] += w
+                num_uniform[:, covered] += fold_mean
+                den_uniform[covered] += 1
+                corr_sum[covered] += corr
+            with np.errstate(invalid='ignore', divide='ignore'):
+                block = np.where(den > 0, num / den, num_uniform / den_uniform)
+                out_corr[roi_ranges[roi][0] + start:roi_ranges[roi][0] + end] = corr_sum / den_uniform
+            out[:, roi_ranges[roi][0] + start:roi_ranges[roi][0] + end] = block
+
+    out.flush()
+    del out
+    os.replace(tmp_path, os.path.join(output_dir, PREDICTIONS_FILE))
+    # mean val corr of the members, an estimate only, the ensemble itself was never validated
+    atomic_save_npy(os.path.join(output_dir, VAL_CORR_FILE), out_corr)
+    index = {'rois': list(roi_sizes), 'roi_ranges': roi_ranges, 'roi_sizes': roi_sizes, 'sub_ranges': sub_ranges,
+             'members': [s.run_dir for s in stores], 'weighting': weighting, 'power': power,
+             'model_key': 'ensemble', 'num_clips': num_clips, 'num_voxels': offset,
+             'val_corr': True, 'voxel_idxs': False}
+    atomic_save_json(os.path.join(output_dir, INDEX_FILE), index)
+    return PredictionStore(output_dir)
+
+
+def save_submission(store, path, num_train=1000):
+    """{roi: {sub: [test clips, voxels]}} pickle of the clips after the first num_train"""
+    results = {}
+    for roi in store.rois:
+        sub_ranges = (store.index.get('sub_ranges') or {}).get(roi)
+        assert sub_ranges, f'no per subject voxel ranges for {roi}'
+        roi_start = store.index['roi_ranges'][roi][0]
+        for sub, (start, end) in sub_ranges.items():
+            results.setdefault(roi, {})[sub] = np.array(store.predictions[num_train:, roi_start + start:roi_start + end])
+    with open(path, 'wb') as f:
+        pickle.dump(results, f)
+    return results
+
+
+def parse_args():
+    parser = ArgumentParser()
+    parser.add_argument('runs', type=str, nargs='+', help='run dirs, or dirs of run dirs (--predictions_dir)')
+    parser.add_argument('--output', type=str, required=True, help='ensemble run dir')
+    parser.add_argument('--weighting', type=str, default='mean', help='mean, val_corr')
+    parser.add_argument('--power', type=float, default=1., help='val_corr weights are max(corr, 0) ** power')
+    parser.add_argument('--no_group_folds', default=False, action="store_true",
+                        help='every run counts as one model instead of averaging folds first')
+    parser.add_argument('--block_voxels', type=int, default=8192)
+    parser.add_argument('--submission', type=str, default='', help='also write the submission pickle here')
+    parser.add_argument('--num_train', type=int, default=1000)
+    args = parser.parse_args()
+    return args
+
+
+if __name__ == '__main__':
+    args = parse_args()
+    stores = [PredictionStore(d) for d in find_runs(args.runs)]
+    print(f'{len(stores)} runs, {len({s.index["model_key"] for s in stores})} models')
+    ensemble = aggregate(stores, args.output, weighting=args.weighting, power=args.power,
+                         block_voxels=args.block_voxels, group_folds=not args.no_group_folds)
+    print('saved ...', args.output, ensemble.predictions.shape)
+    if args.submission:
+        save_submission(ensemble, args.submission, num_train=args.num_train)
+        print('saved ...', args.submission)
@@ -0,0 +1,210 @@
+import os
+import json
+import glob
+import shutil
+import hashlib
+from argparse import ArgumentParser
+from collections import OrderedDict
+from multiprocessing import Pool
+
+import numpy as np
+import pandas as pd
+from tqdm import tqdm
+
+from clip_store import build_clip_store, STORE_FILE as CLIPS_FILE, INDEX_FILE as CLIPS_INDEX_FILE
+from dataloading import build_video_cache, video_cache_name
+from fmri_store import ROIS, SUBS, TRACKS, fmri_store_dir, save_fmri_store, STORE_FILE, INDEX_FILE, MASKS_FILE
+from utils import atomic_save_json, get_fmri
+
+MANIFEST_FILE = 'manifest.json'
+
+
+def file_checksum(path, chunk_size=2 ** 20):
+    h = hashlib.sha1()
+    with open(path, 'rb') as f:
+        for chunk in iter(lambda: f.read(chunk_size), b''):
+            h.update(chunk)
+    return h.hexdigest()
+
+
+def inputs_fingerprint(paths):
+    """cheap identity of a stage's inputs: names, sizes and mtimes"""
+    h = hashlib.sha1()
+    for path in sorted(paths):
+        st = os.stat(path)
+        h.update(f'{os.path.basename(path)}:{st.st_size}:{st.st_mtime_ns};'.encode())
+    return h.hexdigest()
+
+
+class Manifest(object):
+    """manifest.json of the dataset dir: per stage the fingerprint of its inputs and a checksum per output
+
+    A stage is skipped when its inputs did not change and its outputs are still there with the recorded sizes
+    (or checksums, with verify). Large arrays can be recorded by size only.
+    """
+
+    def __init__(self, dataset_dir, verify=False):
+        self.path = os.path.join(dataset_dir, MANIFEST_FILE)
+        self.dataset_dir = dataset_dir
+        self.verify = verify
+        self.stages = {}
+        if os.path.exists(self.path):
+            with open(self.path) as f:
+                self.stages = json.load(f)
+
+    def done(self, stage, fingerprint):
+        entry = self.stages.get(stage)
+        if entry is None or entry['inputs'] != fingerprint:
+            return False
+        for rel_path, meta in entry['outputs'].items():
+            path = os.path.join(self.dataset_dir, rel_path)
+            if not os.path.exists(path) or os.path.getsize(path) != meta['size']:
+                return False
+            if self.verify and meta.get('sha1') and file_checksum(path) != meta['sha1']:
+                return False
+        return True
+
+    def record(self, stage, fingerprint, paths, checksum=True):
+        outputs = {}
+        for path in paths:
+            outputs[os.path.relpath(path, self.dataset_dir)] = {'size': os.path.getsize(path)}
+            if checksum:
+                outputs[os.path.relpath(path, self.dataset_dir)]['sha1'] = file_checksum(path)
+        self.stages[stage] = {'inputs': fingerprint, 'outputs': outputs}
+        atomic_save_json(self.path, self.stages)
+
+
+def link_or_copy(src, dst):
+    """hard link (same filesystem), a copy otherwise; an existing identical file is left alone"""
+    if os.path.exists(dst):
+        if os.path.samefile(src, dst) or os.path.getsize(src) == os.path.getsize(dst):
+            return
+        os.remove(dst)
+    try:
+        os.link(src, dst)
+    except OSError:  # cross-device, or a filesystem without hard links
+        shutil.copy2(src, dst)
+
+
+def _load_subject(job):
+    base_fmri_dir, track, roi, sub = job
+    fmri = get_fmri(os.path.join(base_fmri_dir, track, sub), roi)  # mean over repetitions
+    fmri, mask = fmri if roi == 'WB' else (fmri, None)
+    return roi, sub, fmri.astype(np.float32), mask
+
+
+def load_subjects(base_fmri_dir, track, rois, subs, num_workers):
+    """{(roi, sub): [train clips, voxels]} and {sub: voxel mask}, one pickle per worker at a time"""
+    jobs = [(base_fmri_dir, track, roi, sub) for roi in rois for sub in subs]
+    fmris, masks = {}, {}
+    with Pool(min(num_workers, len(jobs))) as pool:
+        for roi, sub, fmri, mask in tqdm(pool.imap_unordered(_load_subject, jobs), total=len(jobs),
+                                         desc=f'loading {track}'):
+            fmris[(roi, sub)] = fmri
+            if mask is not None:
+                masks[sub] = mask
+    return fmris, masks
+
+
+def write_videos(args, manifest, video_list):
+    """videos/ plus the clip lists: full_vid.csv (train + test) and the train csvs of both tracks"""
+    names = [os.path.basename(v) for v in video_list]
+    fingerprint = inputs_fingerprint(video_list) + f':{args.num_train}:{args.num_predict}'
+    video_dir = os.path.join(args.dataset_dir, 'videos')
+    csvs = [os.path.join(args.dataset_dir, csv) for csv in
+            ['full_vid.csv', TRACKS['mini_track'][1], TRACKS['full_track'][1]]]
+    if manifest.done('videos', fingerprint):
+        print('videos up to date ...', video_dir)
+        return names
+    os.makedirs(video_dir, exist_ok=True)
+    for src, name in zip(tqdm(video_list, desc=f'linking {video_dir}'), names):
+        link_or_copy(src, os.path.join(video_dir, name))
+    pd.DataFrame({'vid': names}).to_csv(csvs[0])
+    for csv in csvs[1:]:
+        # existing train csvs keep their per-file fmri columns, the fallback of load_fmris without a store reads them
+        if os.path.exists(csv) and pd.read_csv(csv)['vid'].tolist() == names[:args.num_train]:
+            continue
+        # new or other clips: targets come from the fmri stores, stale fmri columns would point at other clips
+        pd.DataFrame({'vid': names[:args.num_train]}).to_csv(csv)
+    manifest.record('videos', fingerprint, [os.path.join(video_dir, name) for name in names] + csvs)
+    return names
+
+
+def write_targets(args, manifest, track, clips):
+    rois = args.rois.split(',') if track == 'mini_track' else ['WB']
+    pkls = [os.path.join(args.base_fmri_dir, track, sub, f'{roi}.pkl') for roi in rois for sub in SUBS]
+    fingerprint = inputs_fingerprint(pkls)
+    store_dir = fmri_store_dir(args.dataset_dir, track)
+    outputs = [os.path.join(store_dir, STORE_FILE), os.path.join(store_dir, INDEX_FILE)]
+    if track == 'mini_track':
+        outputs.append(os.path.join(args.dataset_dir, 'config.json'))
+    else:
+        outputs.append(os.path.join(store_dir, MASKS_FILE))
+    if manifest.done(f'targets_{track}', fingerprint):
+        print('targets up to date ...', store_dir)
+        return
+
+    fmris, masks = load_subjects(args.base_fmri_dir, track, rois, SUBS, args.num_workers)
+    if track == 'mini_track':
+        # one column block per roi, subjects concatenated inside it
+        columns = OrderedDict((roi, np.concatenate([fmris[(roi, sub)] for sub in SUBS], 1)) for roi in rois)
+        roi_sub_lens = {roi: [fmris[(roi, sub)].shape[1] for sub in SUBS] for roi in rois}
+        atomic_save_json(outputs[-1], roi_sub_lens)
+        save_fmri_store(store_dir, clips, columns, dtype=args.dtype)
+    else:
+        columns = OrderedDict((sub, fmris[('WB', sub)]) for sub in SUBS)
+        save_fmri_store(store_dir, clips, columns, dtype=args.dtype,
+                        masks=OrderedDict((sub, masks[sub]) for sub in SUBS))
+    manifest.record(f'targets_{track}', fingerprint, outputs)
+
+
+def write_clip_store(args, manifest, names, clip_store):
+    resolution, num_frames, preprocessing_type = clip_store.split('_')
+    fingerprint = inputs_fingerprint([os.path.join(args.dataset_dir, 'videos', name) for name in names])
+    stage = f'clips_{clip_store}'
+    if manifest.done(stage, fingerprint):
+        print('clip store up to date ...', clip_store)
+        return
+    cached_dir = build_video_cache(args.dataset_dir, names, num_frames=int(num_frames), resolution=int(resolution),
+                                   preprocessing_type=preprocessing_type, num_workers=args.num_workers)
+    build_clip_store(cached_dir, [os.path.join(cached_dir, video_cache_name(name)) for name in names])
+    # tens of GB, recorded by size only
+    manifest.record(stage, fingerprint, [os.path.join(cached_dir, f) for f in [CLIPS_FILE, CLIPS_INDEX_FILE]],
+                    checksum=False)
+
+
+def parse_args():
+    parser = ArgumentParser()
+    parser.add_argument('--base_fmri_dir', type=str,
+                        default='/data_smr/huze/projects/Algonauts2021/participants_data_v2021')
+    parser.add_argument('--video_dir', type=str,
+                        default='/data_smr/huze/projects/Algonauts2021/AlgonautsVideos268_All_30fpsmax/')
+    parser.add_argument('--dataset_dir', type=str, default='/home/huze/algonauts_datasets/')
+    parser.add_argument('--tracks', type=str, default='mini_track,full_track')
+    parser.add_argument('--rois', type=str, default=','.join(ROIS))
+    parser.add_argument('--num_train', type=int, default=1000)
+    parser.add_argument('--num_predict', type=int, default=102)
+    parser.add_argument('--dtype', type=str, default='float32', help='fmri store dtype, float32 or float16')
+    parser.add_argument('--clip_stores', type=str, default='',
+                        help='comma separated {resolution}_{frames}_{preprocessing_type}, e.g. 288_16_mmit')
+    parser.add_argument('--num_workers', type=int, default=8)
+    parser.add_argument('--verify', default=False, action="store_true",
+                        help='re-checksum recorded outputs instead of trusting their sizes')
+    args = parser.parse_args()
+    return args
+
+
+def main(args):
+    os.makedirs(args.dataset_dir, exist_ok=True)
+    manifest = Manifest(args.dataset_dir, verify=args.verify)
+    video_list = sorted(glob.glob(os.path.join(args.video_dir, '*.mp4')))[:args.num_train + args.num_predict]
+    names = write_videos(args, manifest, video_list)
+    for track in args.tracks.split(','):
+        write_targets(args, manifest, track, names[:args.num_train])
+    for clip_store in filter(None, args.clip_stores.split(',')):
+        write_clip_store(args, manifest, names, clip_store)
+    print('dataset ready ...', args.dataset_dir)
+
+
+if __name__ == '__main__':
+    main(parse_args())
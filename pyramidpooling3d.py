@@ -1,4 +1,6 @@
 import math
+from functools import lru_cache
+
 import torch
 import torch.nn as nn
 import torch.nn.functional as F
@@ -9,6 +11,67 @@ import torch.nn.functional as F
 # from SoftPool import soft_pool2d, SoftPool2d
 # from SoftPool import soft_pool3d, SoftPool3d
 
+POOL_FNS = {
+    ('max', 2): F.max_pool2d,
+    ('avg', 2): F.avg_pool2d,
+    ('max', 3): F.max_pool3d,
+    ('avg', 3): F.avg_pool3d,
+}
+
+
+@lru_cache(maxsize=None)
+def pyramid_plan(size, levels):
+    """kernel / padding per level for an input of spatial size `size`, levels as ((t, h, w), ...) or ((h, w), ...)
+
+    Also returns the finest level when every level tiles the input without padding and divides it,
+    coarser levels are then pooled from the finest one instead of the full input.
+    """
+    plan = []
+    for level in levels:
+        kernel = tuple(int(math.ceil(s / l)) for s, l in zip(size, level))
+        pad = []
+        for s, l, k in reversed(list(zip(size, level, kernel))):  # F.pad order, last dim first
+            pad += [int(math.floor((k * l - s) / 2)), int(math.ceil((k * l - s) / 2))]
+        plan.append((kernel, tuple(pad) if any(pad) else None))
+
+    finest = max(range(len(levels)), key=lambda i: math.prod(levels[i]))
+    nested = all(pad is None for _, pad in plan) and \
+             all(f % l == 0 for level in levels for f, l in zip(levels[finest], level))
+    return plan, (finest if nested and len(levels) > 1 else None)
+
+
+def pyramid_pool(x, levels, mode, flat=False):
+    """pool every level of the pyramid into one preallocated tensor, levels in order
+
+    [B, C, sum(prod(level))], or with flat [B, sum(C * prod(level))] with each level's block laid out as [C, level].
+    """
+    ndim = len(levels[0])
+    if (mode, ndim) not in POOL_FNS:
+        raise RuntimeError("Unknown pooling type: %s, please use \"max\" or \"avg\"." % mode)
+    pool = POOL_FNS[(mode, ndim)]
+    plan, finest = pyramid_plan(tuple(x.shape[2:]), levels)
+
+    sizes = [math.prod(level) for level in levels]
+    if flat:
+        sizes = [x.shape[1] * n for n in sizes]
+        out = x.new_empty(x.shape[0], sum(sizes))
+    else:
+        out = x.new_empty(x.shape[0], x.shape[1], sum(sizes))
+    if finest is not None:
+        fine = pool(x, plan[finest][0], stride=plan[finest][0])
+    offset = 0
+    for i, ((kernel, pad), level, n) in enumerate(zip(plan, levels, sizes)):
+        if finest is None:
+            pooled = pool(F.pad(x, pad, mode='constant', value=0) if pad is not None else x, kernel, stride=kernel)
+        elif i == finest:
+            pooled = fine
+        else:
+            kernel = tuple(f // l for f, l in zip(levels[finest], level))
+            pooled = pool(fine, kernel, stride=kernel)
+        out[..., offset:offset + n] = pooled.flatten(1 if flat else 2)
+        offset += n
+    return out
+
 
 class PyramidPooling3D(nn.Module):
     def __init__(self, levels, mode="max"):
@@ -45,42 +108,9 @@ class PyramidPooling3D(nn.Module):
                                             where n: sum(filter_amount*level*level) for each level in levels
                                             which is the concentration of multi-level pooling
         """
-        num_sample = previous_conv.size(0)
-        previous_conv_size = [int(previous_conv.size(2)), int(previous_conv.size(3)), int(previous_conv.size(4))]
-        # pooled_xs = dict()
-        for i in range(len(levels[0])):
-            t_kernel = int(math.ceil(previous_conv_size[0] / levels[0][i]))
-            h_kernel = int(math.ceil(previous_conv_size[1] / levels[1][i]))
-            w_kernel = int(math.ceil(previous_conv_size[2] / levels[2][i]))
-            t_pad1 = int(math.floor((t_kernel * levels[0][i] - previous_conv_size[0]) / 2))
-            t_pad2 = int(math.ceil((t_kernel * levels[0][i] - previous_conv_size[0]) / 2))
-            w_pad1 = int(math.floor((w_kernel * levels[2][i] - previous_conv_size[2]) / 2))
-            w_pad2 = int(math.ceil((w_kernel * levels[2][i] - previous_conv_size[2]) / 2))
-            h_pad1 = int(math.floor((h_kernel * levels[1][i] - previous_conv_size[1]) / 2))
-            h_pad2 = int(math.ceil((h_kernel * levels[1][i] - previous_conv_size[1]) / 2))
-            assert w_pad1 + w_pad2 == (w_kernel * levels[2][i] - previous_conv_size[2]) and \
-                   h_pad1 + h_pad2 == (h_kernel * levels[1][i] - previous_conv_size[1]) and \
-                   t_pad1 + t_pad2 == (t_kernel * levels[0][i] - previous_conv_size[0])
-
-            padded_input = F.pad(input=previous_conv, pad=[w_pad1, w_pad2, h_pad1, h_pad2, t_pad1, t_pad2],
-                                 mode='constant', value=0)
-            if mode == "max":
-                pool = nn.MaxPool3d((t_kernel, h_kernel, w_kernel), stride=(t_kernel, h_kernel, w_kernel),
-                                    padding=(0, 0, 0))
-            elif mode == "avg":
-                pool = nn.AvgPool3d((t_kernel, h_kernel, w_kernel), stride=(t_kernel, h_kernel, w_kernel),
-                                    padding=(0, 0, 0))
-                # print((t_kernel, h_kernel, w_kernel), (t_pad1, t_pad2, w_pad1, w_pad2, h_pad1, h_pad1))
-            else:
-                raise RuntimeError("Unknown pooling type: %s, please use \"max\" or \"avg\".")
-            x = pool(padded_input)
-            # pooled_xs[f'level_{i}'] = x.view(num_sample, -1)
-            if i == 0:
-                spp = x.view(num_sample, -1)
-            else:
-                spp = torch.cat((spp, x.view(num_sample, -1)), 1)
-
-        return spp
+        # levels come as [t_levels, h_levels, w_levels]
+        levels = tuple(zip(*[tuple(int(l) for l in ls) for ls in levels]))
+        return pyramid_pool(previous_conv, levels, mode, flat=True)
 
 
 class SpatialPyramidPooling3D(PyramidPooling3D):
@@ -150,34 +180,8 @@ class PyramidPooling2D(nn.Module):
                                             where n: sum(filter_amount*level*level) for each level in levels
                                             which is the concentration of multi-level pooling
         """
-        num_sample = previous_conv.size(0)
-        num_filters = previous_conv.size(1)
-        previous_conv_size = [int(previous_conv.size(2)), int(previous_conv.size(3))]
-        for i in range(len(levels)):
-            h_kernel = int(math.ceil(previous_conv_size[0] / levels[i]))
-            w_kernel = int(math.ceil(previous_conv_size[1] / levels[i]))
-            w_pad1 = int(math.floor((w_kernel * levels[i] - previous_conv_size[1]) / 2))
-            w_pad2 = int(math.ceil((w_kernel * levels[i] - previous_conv_size[1]) / 2))
-            h_pad1 = int(math.floor((h_kernel * levels[i] - previous_conv_size[0]) / 2))
-            h_pad2 = int(math.ceil((h_kernel * levels[i] - previous_conv_size[0]) / 2))
-            assert w_pad1 + w_pad2 == (w_kernel * levels[i] - previous_conv_size[1]) and \
-                   h_pad1 + h_pad2 == (h_kernel * levels[i] - previous_conv_size[0])
-
-            padded_input = F.pad(input=previous_conv, pad=[w_pad1, w_pad2, h_pad1, h_pad2],
-                                 mode='constant', value=0)
-            if mode == "max":
-                pool = nn.MaxPool2d((h_kernel, w_kernel), stride=(h_kernel, w_kernel), padding=(0, 0))
-            elif mode == "avg":
-                pool = nn.AvgPool2d((h_kernel, w_kernel), stride=(h_kernel, w_kernel), padding=(0, 0))
-            else:
-                raise RuntimeError("Unknown pooling type: %s, please use \"max\" or \"avg\".")
-            x = pool(padded_input)
-            if i == 0:
-                spp = x.view(num_sample, num_filters, -1)
-            else:
-                spp = torch.cat((spp, x.view(num_sample, num_filters, -1)), -1)
-
-        return spp
+        levels = tuple((int(l), int(l)) for l in levels)
+        return pyramid_pool(previous_conv, levels, mode)
 
 
 class SpatialPyramidPooling2D(PyramidPooling2D):
@@ -0,0 +1,156 @@
+import math
+from functools import lru_cache
+
+import torch
+import torch.nn.functional as F
+
+
+def is_oom(e):
+    return isinstance(e, RuntimeError) and 'out of memory' in str(e)
+
+
+class ChunkedInputGrads(object):
+    """d out[voxel] / d input for a chunk of voxels per backward, instead of one backward per voxel
+
+    Uses torch.autograd.grad(is_grads_batched=True) (vmap over the backward), falls back to a loop over the
+    chunk if the graph has ops without a batching rule. The chunk size halves on CUDA OOM and stays halved
+    for later calls.
+    """
+
+    def __init__(self, chunk_size=64, scale=1e5):
+        self.chunk_size = chunk_size
+        self.scale = scale
+        self.batched = True
+
+    def input_grads(self, out, inp, voxels):
+        grad_outputs = torch.zeros(len(voxels), out.numel(), device=out.device, dtype=out.dtype)
+        grad_outputs[torch.arange(len(voxels), device=out.device), voxels] = self.scale
+        grad_outputs = grad_outputs.reshape(len(voxels), *out.shape)
+        if self.batched:
+            try:
+                grads, = torch.autograd.grad(out, inp, grad_outputs, retain_graph=True, is_grads_batched=True)
+                return grads
+            except (RuntimeError, TypeError) as e:
+                if is_oom(e):
+                    raise
+                print('batched grads not supported, looping over voxels ...', e)
+                self.batched = False
+        return torch.stack([torch.autograd.grad(out, inp, g, retain_graph=True)[0] for g in grad_outputs])
+
+    def __call__(self, out, inp, voxels, post=None):
+        """grads (or post(grads), a dict of tensors) for all voxels, concatenated over chunks
+
+        out is one sample's output vector, inp the input that requires grad, grads are [voxels, *inp.shape].
+        """
+        voxels = torch.as_tensor(voxels, device=out.device)
+        results = []
+        start = 0
+        while start < len(voxels):
+            chunk = voxels[start:start + self.chunk_size]
+            try:
+                grads = self.input_grads(out, inp, chunk)
+                results.append(post(grads) if post is not None else {'grads': grads})
+            except RuntimeError as e:
+                if not is_oom(e) or self.chunk_size == 1:
+                    raise
+                self.chunk_size //= 2
+                torch.cuda.empty_cache()
+                print('out of memory, voxel chunk size ...', self.chunk_size)
+                continue
+            start += len(chunk)
+        return {k: torch.cat([r[k] for r in results], 0) for k in results[0].keys()}
+
+
+@lru_cache(maxsize=None)
+def dct_matrix(n, device, dtype=torch.float32):
+    """orthonormal DCT-II basis, rows are frequencies: dct(x, norm='ortho') == D @ x"""
+    k = torch.arange(n, dtype=torch.float64)[:, None]
+    i = torch.arange(n, dtype=torch.float64)[None, :]
+    d = torch.cos(math.pi * (2 * i + 1) * k / (2 * n)) * math.sqrt(2 / n)
+    d[0] /= math.sqrt(2)
+    return d.to(device=device, dtype=dtype)
+
+
+def dct_2d(x, keep=None):
+    """2D ortho DCT-II over the last two dims (fftpack.dct applied along both), low `keep` x `keep` coefficients"""
+    h, w = x.shape[-2:]
+    dh, dw = dct_matrix(h, x.device, x.dtype), dct_matrix(w, x.device, x.dtype)
+    if keep is not None:
+        dh, dw = dh[:keep], dw[:keep]
+    return dh @ x @ dw.T
+
+
+def downsample(grads, resolution):
+    """[N, 1, C, T, H, W] input grads -> [N, C, T, resolution, resolution]"""
+    grads = grads.flatten(0, 1)
+    return F.interpolate(grads, size=(grads.shape[-3], resolution, resolution))
+
+
+def dct_summary(grads, resolution, d_reso, m=10):
+    """v1v4 saliency: grey grads, per voxel median / outlier clipping / 0-255 rescale, low frequency DCT per frame"""
+    grad = downsample(grads, resolution).mean(1)  # grey, N x T x H x W
+    n, t = grad.shape[:2]
+    out = {}
+
+    grad_2 = grad ** 2
+    out['mods_video_before_rescale'] = torch.sqrt(grad_2.sum((1, 2, 3)))
+    out['mods_image_before_rescale'] = torch.sqrt(grad_2.sum(-1).sum(-1))
+
+    # median
+    median = grad.reshape(n, -1).median(-1)[0]
+    out['medians_video'] = median
+    out['medians_image'] = grad.reshape(n, t, -1).median(-1)[0]
+
+    # reject outliers
+    median = median.reshape(n, 1, 1, 1)
+    d = torch.abs(grad - median)
+    mdev = d.reshape(n, -1).median(-1)[0].reshape(n, 1, 1, 1)
+    mdev = torch.where(mdev != 0, mdev, torch.ones_like(mdev))
+    mmax = median + m * mdev
+    mmin = median - m * mdev
+    grad = torch.minimum(torch.maximum(grad, mmin), mmax)
+
+    # rescale
+    grad = 255 * (grad - mmin) / (mmax - mmin)
+
+    grad_2 = grad ** 2
+    out['mods_video_after_rescale'] = torch.sqrt(grad_2.sum((1, 2, 3)))
+    out['mods_image_after_rescale'] = torch.sqrt(grad_2.sum(-1).sum(-1))
+
+    out['d_coeffs'] = dct_2d(grad, keep=d_reso)
+    return out
+
+
+def tmax_summary(grads, resolution, mean, std):
+    """cgcs saliency: de-normalized grey grads, max over time"""
+    grad = downsample(grads, resolution)
+    grad = grad.permute(0, 2, 3, 4, 1)
+    grad = grad * std + mean
+    grad = grad.mean(-1)  # grey
+    return {'tmax': grad.max(1)[0]}  # max-pooling
+
+
+class SaliencySummarizer(object):
+    """post-processing of ChunkedInputGrads chunks, runs on the grads' device; summaries go to a ColumnStore
+
+    mode 'dct' is the v1v4 summary (moduli, medians, low frequency DCT), 'tmax' the cgcs one.
+    """
+
+    def __init__(self, mode='dct', resolution=128, d_reso=16, mean=None, std=None):
+        self.mode = mode
+        self.resolution = resolution
+        self.d_reso = d_reso
+        self.mean = mean
+        self.std = std
+
+    def __call__(self, grads):
+        if self.mode == 'dct':
+            return dct_summary(grads, self.resolution, self.d_reso)
+        elif self.mode == 'tmax':
+            return tmax_summary(grads, self.resolution, self.mean, self.std)
+        else:
+            raise NotImplementedError(self.mode)
+
+    @staticmethod
+    def to_columns(summary):
+        return {k: v.detach().cpu().numpy() for k, v in summary.items()}
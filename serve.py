@@ -0,0 +1,194 @@
+import os
+import json
+import time
+import queue
+import threading
+from functools import partial
+from argparse import ArgumentParser
+from http.server import BaseHTTPRequestHandler, ThreadingHTTPServer
+
+import numpy as np
+import torch
+
+from dataloading import load_video_batched
+from feature_cache import FeatureStore, feature_cache_key
+from main import LitModel, build_backbone, checkpoint_voxel_idxs
+
+
+def load_model(ckpt_path, device):
+    """LitModel from a checkpoint alone, hparams come from the checkpoint"""
+    ckpt = torch.load(ckpt_path, map_location='cpu')
+    hparams = ckpt['hyper_parameters']
+    plmodel = LitModel.load_from_checkpoint(ckpt_path, backbone=build_backbone(hparams), hparams=hparams,
+                                            voxel_idxs=checkpoint_voxel_idxs(ckpt))
+    return plmodel.to(device).eval()
+
+
+class MicroBatcher(object):
+    """collects single-clip requests from many threads into batches of up to max_batch
+
+    A batch runs once it is full or max_wait seconds after its first request arrived.
+    """
+
+    def __init__(self, fn, max_batch=16, max_wait=0.01):
+        self.fn = fn
+        self.max_batch = max_batch
+        self.max_wait = max_wait
+        self.requests = queue.Queue()
+        threading.Thread(target=self.loop, daemon=True).start()
+
+    def submit(self, x):
+        item = {'x': x, 'done': threading.Event()}
+        self.requests.put(item)
+        return item
+
+    @staticmethod
+    def result(item):
+        item['done'].wait()
+        if 'error' in item:
+            raise item['error']
+        return item['out']
+
+    def loop(self):
+        while True:
+            items = [self.requests.get()]
+            deadline = time.time() + self.max_wait
+            while len(items) < self.max_batch:
+                timeout = deadline - time.time()
+                if timeout <= 0:
+                    break
+                try:
+                    items.append(self.requests.get(timeout=timeout))
+                except queue.Empty:
+                    break
+            try:
+                batch = {k: torch.stack([item['x'][k] for item in items]) for k in items[0]['x']}
+                outs = self.fn(batch)
+                for i, item in enumerate(items):
+                    item['out'] = {k: v[i] for k, v in outs.items()}
+            except Exception as e:
+                for item in items:
+                    item['error'] = e
+            finally:
+                for item in items:
+                    item['done'].set()
+
+
+class InferenceServer(object):
+    """checkpoints loaded once and kept on the device, per (model, input kind) micro-batching"""
+
+    def __init__(self, ckpts, device, features_dir='', max_batch=16, max_wait_ms=10.):
+        self.device = device
+        self.features_dir = features_dir
+        self.models = {}
+        for name, ckpt_path in ckpts.items():
+            print('loading ...', name, ckpt_path)
+            self.models[name] = load_model(ckpt_path, device)
+        self.batchers = {(name, kind): MicroBatcher(partial(self.forward, name), max_batch, max_wait_ms / 1000)
+                         for name in self.models for kind in ('clips', 'features')}
+        # the clips and features batchers share a model, LitModel.forward keeps state on it (out_vid)
+        self.locks = {name: threading.Lock() for name in self.models}
+
+    @torch.no_grad()
+    def forward(self, name, x):
+        plmodel = self.models[name]
+        x = {k: v.to(self.device, non_blocking=True) for k, v in x.items()}
+        if 'video' in x:
+            x['video'] = plmodel.normalize_input(x['video'])
+            x['video'] = plmodel.test_transform(x['video']) if plmodel.test_transform is not None else x['video']
+        with self.locks[name]:
+            out, _ = plmodel(x)
+            return {roi: v.float().cpu() for roi, v in out.items()}
+
+    def load_inputs(self, name, request):
+        hparams = self.models[name].hparams
+        if 'clips' in request:
+            return 'clips', [{'video': load_video_batched(clip, hparams.video_frames, hparams.video_size,
+                                                          hparams.preprocessing_type)}
+                             for clip in request['clips']]
+        elif 'features' in request:
+            key, _ = feature_cache_key(hparams)
+            store = FeatureStore(os.path.join(self.features_dir, key), request['features'],
+                                 hparams.pyramid_layers.split(','))
+            return 'features', [store[i] for i in range(len(store))]
+        raise ValueError('request needs "clips" (video paths) or "features" (cached clip names)')
+
+    def predict(self, request):
+        name = request['model']
+        if name not in self.models:
+            raise KeyError(f'unknown model {name}, serving {sorted(self.models)}')
+        kind, xs = self.load_inputs(name, request)
+        batcher = self.batchers[(name, kind)]
+        items = [batcher.submit(x) for x in xs]
+        outs = [MicroBatcher.result(item) for item in items]
+        return {roi: torch.stack([out[roi] for out in outs]).numpy() for roi in outs[0]}
+
+    def describe(self):
+        # voxel_idxs: output columns of a model trained on a voxel subset, None for all voxels
+        return {name: {'rois': m.hparams.rois, 'backbone_type': m.hparams.backbone_type,
+                       'output_size': m.hparams.output_size, 'idx_ends': m.hparams.idx_ends,
+                       'voxel_idxs': None if m.trained_voxel_idxs is None else
+                       np.asarray(m.trained_voxel_idxs).tolist()}
+                for name, m in self.models.items()}
+
+
+def make_handler(server):
+    class Handler(BaseHTTPRequestHandler):
+        def send_json(self, code, obj):
+            body = json.dumps(obj).encode()
+            self.send_response(code)
+            self.send_header('Content-Type', 'application/json')
+            self.send_header('Content-Length', str(len(body)))
+            self.end_headers()
+            self.wfile.write(body)
+
+        def do_GET(self):
+            if self.path == '/models':
+                self.send_json(200, server.describe())
+            else:
+                self.send_json(404, {'error': 'GET /models, POST /predict'})
+
+        def do_POST(self):
+            if self.path != '/predict':
+                self.send_json(404, {'error': 'GET /models, POST /predict'})
+                return
+            try:
+                request = json.loads(self.rfile.read(int(self.headers['Content-Length'])))
+                predictions = server.predict(request)
+                if request.get('save_to'):  # large outputs (WB) as npy instead of json
+                    np.save(request['save_to'], predictions)
+                    self.send_json(200, {'saved_to': request['save_to']})
+                else:
+                    self.send_json(200, {roi: v.tolist() for roi, v in predictions.items()})
+            except Exception as e:
+                self.send_json(400, {'error': repr(e)})
+
+    return Handler
+
+
+def parse_args():
+    parser = ArgumentParser()
+    parser.add_argument('ckpts', type=str, nargs='+', help='name=path/to.ckpt, or a path (named by its dir)')
+    parser.add_argument('--port', type=int, default=8765)
+    parser.add_argument('--device', type=str, default='cuda:0' if torch.cuda.is_available() else 'cpu')
+    parser.add_argument('--features_dir', type=str, default='', help='--backbone_features_dir of the runs')
+    parser.add_argument('--max_batch', type=int, default=16)
+    parser.add_argument('--max_wait_ms', type=float, default=10.)
+    args = parser.parse_args()
+    return args
+
+
+def main(args):
+    ckpts = {}
+    for ckpt in args.ckpts:
+        name, path = ckpt.split('=', 1) if '=' in ckpt else (os.path.basename(os.path.dirname(ckpt)), ckpt)
+        ckpts[name] = path
+    server = InferenceServer(ckpts, torch.device(args.device), features_dir=args.features_dir,
+                             max_batch=args.max_batch, max_wait_ms=args.max_wait_ms)
+    httpd = ThreadingHTTPServer(('127.0.0.1', args.port), make_handler(server))
+    print(f'serving {sorted(server.models)} on 127.0.0.1:{args.port} ...')
+    httpd.serve_forever()
+
+
+if __name__ == '__main__':
+    main(parse_args())
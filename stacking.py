@@ -0,0 +1,192 @@
+import os
+from argparse import ArgumentParser
+from collections import OrderedDict
+
+import numpy as np
+import torch
+from tqdm import tqdm
+
+from dataloading import AlgonautsDatasetFreeze
+from prediction_store import PredictionStore, find_runs, save_submission, INDEX_FILE, PREDICTIONS_FILE, \
+    VAL_CORR_FILE
+from utils import atomic_save_json, atomic_save_npy
+
+WEIGHTS_FILE = 'weights.npy'
+
+
+def load_targets(datasets_dir, track, roi, subs='all'):
+    """[train clips, voxels] fmri of a whole roi, columns as in the runs' roi_ranges"""
+    dataset = AlgonautsDatasetFreeze(datasets_dir, rois=roi, train=True, track=track, subs=subs)
+    return dataset.fmris.numpy()
+
+
+def nnls(gram, xty, iters=500, tol=1e-7):
+    """min 0.5 w'Gw - w'r s.t. w >= 0 for a batch of [M, M] G, cyclic coordinate descent over the M models
+
+    Exact for the (ridge) strictly convex problem, every voxel of the batch updates at once.
+    """
+    w = torch.zeros_like(xty)
+    diag = torch.diagonal(gram, dim1=1, dim2=2)
+    for _ in range(iters):
+        max_step = 0.
+        for m in range(w.shape[1]):
+            step = (xty[:, m] - (gram[:, m] * w).sum(1)) / diag[:, m]
+            new = torch.clamp(w[:, m] + step, min=0)
+            max_step = max(max_step, (new - w[:, m]).abs().max().item())
+            w[:, m] = new
+        if max_step <= tol * max(w.abs().max().item(), 1e-12):
+            break
+    return w
+
+
+def fit_weights(x, y, covered, alpha=1e-3, method='nnls'):
+    """per voxel stacking weights and intercepts, one batched solve for a block of voxels
+
+    x: [voxels, rows, models] oof predictions, y: [voxels, rows] fmri, covered: [voxels, models], models not
+    covering a voxel get weight 0. ridge penalty is alpha * mean(diag(X'X)) so it does not depend on the scale.
+    """
+    x = x * covered[:, None, :]
+    x_mean, y_mean = x.mean(1, keepdim=True), y.mean(1, keepdim=True)
+    xc, yc = (x - x_mean).double(), (y - y_mean).double()
+    gram = torch.bmm(xc.transpose(1, 2), xc)
+    xty = torch.bmm(xc.transpose(1, 2), yc[..., None])[..., 0]
+    scale = torch.diagonal(gram, dim1=1, dim2=2).mean(1).clamp(min=1e-12)
+    eye = torch.eye(gram.shape[-1], dtype=gram.dtype)
+    gram = gram + (max(alpha, 1e-6) * scale)[:, None, None] * eye
+    if method == 'ridge':
+        w = torch.linalg.solve(gram, xty[..., None])[..., 0]
+    elif method == 'nnls':
+        w = nnls(gram, xty)
+    else:
+        raise NotImplementedError(method)
+    w = (w * covered).float()
+    intercept = y_mean[:, 0] - (w * x_mean[:, 0]).sum(1)
+    return w, intercept
+
+
+def column_corr(x, y):
+    """pearson r of every column, x and y [rows, voxels]"""
+    xc, yc = x - x.mean(0), y - y.mean(0)
+    return (xc * yc).sum(0) / (np.sqrt((xc ** 2).sum(0) * (yc ** 2).sum(0)) + 1e-8)
+
+
+def stack(stores, output_dir, datasets_dir, alpha=1e-3, method='nnls', block_voxels=2048):
+    """fit per voxel weights of the models (fold groups) on their out-of-fold predictions, apply them to the
+    fold averaged test predictions; the output is a prediction_store run dir plus weights.npy
+    """
+    models = OrderedDict()
+    for s in stores:
+        assert s.oof is not None, f'no out-of-fold predictions in {s.run_dir}'
+        models.setdefault(s.index['model_key'], []).append(s)
+    num_models = len(models)
+    num_clips = stores[0].index['num_clips']
+
+    roi_sizes, sub_ranges, track = OrderedDict(), {}, stores[0].index['track']
+    for s in stores:
+        for roi in s.rois:
+            roi_sizes.setdefault(roi, s.index['roi_sizes'][roi])
+            if (s.index.get('sub_ranges') or {}).get(roi):
+                sub_ranges[roi] = s.index['sub_ranges'][roi]
+    roi_ranges = OrderedDict()
+    offset = 0
+    for roi, size in roi_sizes.items():
+        roi_ranges[roi] = [offset, offset + size]
+        offset += size
+
+    os.makedirs(output_dir, exist_ok=True)
+    tmp_path = os.path.join(output_dir, f'{PREDICTIONS_FILE}.tmp{os.getpid()}')
+    out = np.lib.format.open_memmap(tmp_path, mode='w+', dtype=np.float32, shape=(num_clips, offset))
+    weights = np.zeros((offset, num_models), dtype=np.float32)
+    out_corr = np.full(offset, np.nan, dtype=np.float32)
+    report = {'models': np.zeros(num_models), 'mean': 0., 'stacked': 0., 'voxels': 0}
+
+    for roi, size in roi_sizes.items():
+        subs = ','.join(sub_ranges[roi]) if track == 'full_track' and roi in sub_ranges else 'all'
+        y_all = load_targets(datasets_dir, track, roi, subs=subs)
+        for start in tqdm(range(0, size, block_voxels), desc=f'{roi}, {num_models} models, {method}'):
+            end = min(start + block_voxels, size)
+            n = end - start
+            oof = np.full((len(y_all), n, num_models), np.nan, dtype=np.float32)
+            test = np.zeros((num_clips, n, num_models), dtype=np.float32)
+            counts = np.zeros((n, num_models))
+            for m, runs in enumerate(models.values()):
+                for s in runs:
+                    if roi not in s.rois:
+                        continue
+                    cols, dst = s.roi_columns(roi, start, end)
+                    rows = s.oof_rows
+                    block = np.full((len(rows), n), np.nan, dtype=np.float32)
+                    block[:, dst] = s.oof[:, cols]
+                    oof[rows, :, m] = np.where(np.isnan(block), oof[rows, :, m], block)
+                    test[:, dst, m] += s.predictions[:, cols]
+                    counts[dst, m] += 1
+            covered = counts > 0
+            test = test / np.maximum(counts, 1)
+            # clips with an oof prediction from every model covering the voxel
+            rows = np.where((~np.isnan(oof) | ~covered[None]).all((1, 2)) & ~np.isnan(oof).all((1, 2)))[0]
+            x = torch.from_numpy(np.nan_to_num(oof[rows]).transpose(1, 0, 2).copy())
+            y = torch.from_numpy(y_all[rows, start:end].T.astype(np.float32).copy())
+            w, intercept = fit_weights(x, y, torch.from_numpy(covered.astype(np.float32)), alpha=alpha,
+                                       method=method)
+            w, intercept = w.numpy(), intercept.numpy()
+
+            col = roi_ranges[roi][0] + start
+            out[:, col:col + n] = (test * w[None]).sum(-1) + intercept[None]
+            weights[col:col + n] = w
+            stacked = (x * torch.from_numpy(w)[:, None]).sum(-1).numpy().T + intercept[None]
+            out_corr[col:col + n] = column_corr(stacked, y_all[rows, start:end])
+
+            y_rows = y_all[rows, start:end]
+            for m in range(num_models):
+                report['models'][m] += np.nansum(np.where(covered[:, m], column_corr(oof[rows, :, m], y_rows), 0))
+            mean = (np.nan_to_num(oof[rows]) * covered[None]).sum(-1) / np.maximum(covered.sum(-1), 1)[None]
+            report['mean'] += np.nansum(column_corr(mean, y_rows))
+            report['stacked'] += np.nansum(out_corr[col:col + n])
+            report['voxels'] += n
+
+    out.flush()
+    del out
+    os.replace(tmp_path, os.path.join(output_dir, PREDICTIONS_FILE))
+    atomic_save_npy(os.path.join(output_dir, WEIGHTS_FILE), weights)
+    # in-sample corr of the stacked oof predictions, optimistic
+    atomic_save_npy(os.path.join(output_dir, VAL_CORR_FILE), out_corr)
+    index = {'rois': list(roi_sizes), 'roi_ranges': roi_ranges, 'roi_sizes': roi_sizes, 'sub_ranges': sub_ranges,
+             'track': track, 'members': [s.run_dir for s in stores], 'models': list(models),
+             'weighting': f'stack_{method}', 'alpha': alpha, 'model_key': f'stack_{method}',
+             'num_clips': num_clips, 'num_voxels': offset, 'val_corr': True, 'voxel_idxs': False}
+    atomic_save_json(os.path.join(output_dir, INDEX_FILE), index)
+
+    voxels = max(report['voxels'], 1)
+    for key, corr in zip(models, report['models']):
+        print(f'oof corr {corr / voxels:.6f} model {key}')
+    print(f'oof corr {report["mean"] / voxels:.6f} mean of {num_models} models')
+    print(f'oof corr {report["stacked"] / voxels:.6f} stacked (in-sample)')
+    return PredictionStore(output_dir)
+
+
+def parse_args():
+    parser = ArgumentParser()
+    parser.add_argument('runs', type=str, nargs='+', help='run dirs, or dirs of run dirs (--predictions_dir)')
+    parser.add_argument('--output', type=str, required=True, help='stacked run dir')
+    parser.add_argument('--datasets_dir', type=str, default='/home/huze/algonauts_datasets/')
+    parser.add_argument('--method', type=str, default='nnls', help='nnls, ridge')
+    parser.add_argument('--alpha', type=float, default=1e-3, help='ridge penalty, relative to mean(diag(X\'X))')
+    parser.add_argument('--block_voxels', type=int, default=2048)
+    parser.add_argument('--num_threads', type=int, default=0, help='torch cpu threads, 0 for the default')
+    parser.add_argument('--submission', type=str, default='', help='also write the submission pickle here')
+    parser.add_argument('--num_train', type=int, default=1000)
+    args = parser.parse_args()
+    return args
+
+
+if __name__ == '__main__':
+    args = parse_args()
+    if args.num_threads > 0:
+        torch.set_num_threads(args.num_threads)
+    stores = [PredictionStore(d) for d in find_runs(args.runs)]
+    stacked = stack(stores, args.output, args.datasets_dir, alpha=args.alpha, method=args.method,
+                    block_voxels=args.block_voxels)
+    print('saved ...', args.output, stacked.predictions.shape)
+    if args.submission:
+        save_submission(stacked, args.submission, num_train=args.num_train)
+        print('saved ...', args.submission)
@@ -0,0 +1,31 @@
+import numpy as np
+import pytest
+import torch
+
+from utils import roi_scores
+
+
+def test_voxel_subset_mini_track():
+    # idx_ends cover all 10 columns, voxel_corrs only the 4 trained ones
+    idx_ends = [3, 7, 10]
+    voxel_idxs = np.array([1, 2, 8, 9])
+    voxel_corrs = torch.tensor([0.1, 0.3, 0.5, 0.7])
+    scores = roi_scores(voxel_corrs, ['V1', 'V2', 'V3'], idx_ends, voxel_idxs=voxel_idxs)
+    assert list(scores) == ['V1', 'V3']  # no V2 voxel was trained
+    assert scores['V1'] == pytest.approx(0.2)
+    assert scores['V3'] == pytest.approx(0.6)
+
+
+def test_voxel_subset_beyond_idx_ends():
+    with pytest.raises(AssertionError):
+        roi_scores(torch.zeros(2), ['V1', 'V2'], [3, 5], voxel_idxs=np.array([1, 5]))
+
+
+def test_full_track_label_order():
+    subs = ['sub01', 'sub02', 'sub03']
+    sub_idx_ends = [2, 5, 6]
+    voxel_corrs = torch.tensor([1., 1., 2., 2., 2., 4.])
+    scores = roi_scores(voxel_corrs, ['WB'], [6], subs=subs, sub_idx_ends=sub_idx_ends)
+    assert list(scores) == ['WB', 'WB_sub01', 'WB_sub02', 'WB_sub03']
+    assert scores['WB'] == pytest.approx(2.)
+    assert [scores[f'WB_{sub}'] for sub in subs] == pytest.approx([1., 2., 4.])
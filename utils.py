@@ -1,4 +1,7 @@
+import contextlib
+import fcntl
 import functools
+import json
 import os
 import pathlib
 import pickle
@@ -54,6 +57,38 @@ def vectorized_correlation(x, y):
     return corr.ravel()
 
 
+class StreamingCorrelation(object):
+    """vectorized_correlation over batches: running float64 per-voxel sums, O(voxels) memory
+
+    Sums are all_reduced across DDP ranks in compute(), so every rank returns the correlation over all samples.
+    """
+
+    def __init__(self):
+        self.reset()
+
+    def reset(self):
+        self.n = 0
+        self.sums = None  # 5 x V: x, y, x^2, y^2, xy
+
+    def update(self, x, y):
+        x, y = x.detach().double(), y.detach().double()
+        sums = torch.stack([x.sum(0), y.sum(0), (x * x).sum(0), (y * y).sum(0), (x * y).sum(0)])
+        self.sums = sums if self.sums is None else self.sums + sums
+        self.n += x.shape[0]
+
+    def compute(self):
+        sums, n = self.sums, torch.tensor(float(self.n), dtype=torch.float64, device=self.sums.device)
+        if torch.distributed.is_available() and torch.distributed.is_initialized():
+            sums = sums.clone()
+            torch.distributed.all_reduce(sums)
+            torch.distributed.all_reduce(n)
+        sx, sy, sxx, syy, sxy = sums
+        covariance = (sxy - sx * sy / n) / (n - 1)
+        x_std = ((sxx - sx * sx / n) / (n - 1)).clamp(min=0).sqrt() + 1e-8
+        y_std = ((syy - sy * sy / n) / (n - 1)).clamp(min=0).sqrt() + 1e-8
+        return (covariance / (x_std * y_std)).float()
+
+
 def dokodemo_hsplit(x, idxs):
     ret = []
     for i in range(len(idxs)):
@@ -64,41 +99,63 @@ def dokodemo_hsplit(x, idxs):
     return ret
 
 
+def segment_mean(values, idx_ends):
+    """mean over each segment of the last dim, segments given by their idx_ends, one index_add on the device"""
+    idx_ends = torch.as_tensor(np.asarray(idx_ends), device=values.device)
+    lens = torch.diff(idx_ends, prepend=idx_ends.new_zeros(1))
+    segment_ids = torch.repeat_interleave(torch.arange(len(lens), device=values.device), lens)
+    assert values.shape[-1] == len(segment_ids), f'{values.shape[-1]} columns, idx_ends end at {len(segment_ids)}'
+    sums = values.new_zeros(*values.shape[:-1], len(lens)).index_add_(values.dim() - 1, segment_ids, values)
+    return sums / lens.to(values.dtype)
+
+
+def roi_scores(voxel_corrs, rois, idx_ends, voxel_idxs=None, subs=None, sub_idx_ends=None):
+    """{name: mean voxel corr} of the rois (segments of idx_ends), then of the subs (segments of sub_idx_ends,
+    named {rois[0]}_{sub}) when given
+
+    Ends are in the space of all voxels, voxel_idxs place the columns of voxel_corrs in it (None: column i is
+    voxel i). A single roi is the mean over every column. Segments without a column are left out.
+    """
+    device = voxel_corrs.device
+    positions = torch.arange(len(voxel_corrs), device=device) if voxel_idxs is None else \
+        torch.as_tensor(np.asarray(voxel_idxs), dtype=torch.long, device=device)
+    segments = [(rois, None if len(rois) == 1 else idx_ends)]
+    if sub_idx_ends is not None:
+        segments.append(([f'{rois[0]}_{sub}' for sub in subs], sub_idx_ends))
+    names, sums, counts = [], [], []
+    for seg_names, ends in segments:
+        if ends is None:
+            seg = torch.zeros_like(positions)
+        else:
+            last = len(voxel_corrs) if voxel_idxs is None else int(np.max(voxel_idxs)) + 1
+            assert last <= ends[-1], f'voxel {last - 1} beyond the last segment end {ends[-1]}'
+            seg = torch.searchsorted(torch.as_tensor(np.asarray(ends), device=device), positions, right=True)
+        names += seg_names
+        sums.append(voxel_corrs.new_zeros(len(seg_names)).index_add_(0, seg, voxel_corrs))
+        counts.append(torch.bincount(seg, minlength=len(seg_names)))
+    # one host transfer for everything
+    sums, counts = torch.cat(sums).tolist(), torch.cat(counts).tolist()
+    return {name: s / c for name, s, c in zip(names, sums, counts) if c > 0}
+
+
 def roi_correlation(x, y, roi_keys, roi_idx):
-    xx = hsplit(x, roi_idx)
-    yy = hsplit(y, roi_idx)
-    subs = np.unique(roi_keys[:, 1])
-    rois = np.unique(roi_keys[:, 0])
+    # one (roi, sub) segment per row of roi_keys, a single host transfer for all of them
+    corrs = segment_mean(vectorized_correlation(x, y), roi_idx).tolist()
 
     corrs_dict = {}
-    roi_mean_corr_dict = {}
-    i = 0
-    for roi in rois:
-        sub_corrs = {}
-        for sub in subs:
-            a, b = xx[i], yy[i]
-            corr = vectorized_correlation(a, b).mean().item()
-            sub_corrs[sub] = corr
-            i += 1
-        corrs_dict[roi] = sub_corrs
-        roi_mean_corr_dict[roi] = np.mean(list(sub_corrs.values()))
+    for (roi, sub), corr in zip(roi_keys, corrs):
+        corrs_dict.setdefault(roi, {})[sub] = corr
+    roi_mean_corr_dict = {roi: np.mean(list(sub_corrs.values())) for roi, sub_corrs in corrs_dict.items()}
 
     return corrs_dict, roi_mean_corr_dict, np.mean(list(roi_mean_corr_dict.values()))
 
 
 def roi_results(x, roi_keys, roi_idx):
-    xx = hsplit(x, roi_idx)
-    subs = np.unique(roi_keys[:, 1])
-    rois = np.unique(roi_keys[:, 0])
+    xx = dokodemo_hsplit(x.cpu(), roi_idx)
 
     results = {}
-    i = 0
-    for roi in rois:
-        sub_results = {}
-        for sub in subs:
-            sub_results[sub] = xx[i].cpu().numpy()
-            i += 1
-        results[roi] = sub_results
+    for (roi, sub), xi in zip(roi_keys, xx):
+        results.setdefault(roi, {})[sub] = xi.numpy()
 
     return results
 
@@ -277,6 +334,42 @@ def save_fn_np(arr, save_dir, file_name):
     np.save(os.path.join(save_dir, file_name), arr)
 
 
+def atomic_save_npy(path, arr):
+    """np.save to a temp file in the same dir then rename, readers never see a truncated file"""
+    tmp_path = f'{path}.tmp{os.getpid()}'
+    with open(tmp_path, 'wb') as f:
+        np.save(f, arr)
+        f.flush()
+        os.fsync(f.fileno())
+    os.replace(tmp_path, path)
+
+
+def atomic_save_json(path, obj):
+    tmp_path = f'{path}.tmp{os.getpid()}'
+    with open(tmp_path, 'w') as f:
+        json.dump(obj, f)
+    os.replace(tmp_path, path)
+
+
+def is_valid_npy(path):
+    try:
+        np.load(path, mmap_mode='r')
+        return True
+    except (OSError, ValueError):
+        return False
+
+
+@contextlib.contextmanager
+def file_lock(path):
+    """exclusive inter-process lock, blocks until the holder releases it"""
+    with open(path, 'a') as f:
+        fcntl.flock(f, fcntl.LOCK_EX)
+        try:
+            yield
+        finally:
+            fcntl.flock(f, fcntl.LOCK_UN)
+
+
 def load_categories(filename):
     """Load categories."""
     with open(filename) as f:
@@ -27,6 +27,9 @@ from main import LitModel
 from bdcn import load_bdcn
 from model_i3d import *
 from i3d_flow import *
+from saliency import ChunkedInputGrads, SaliencySummarizer
+from column_store import ColumnStore
+from job_queue import JobQueue, default_worker_name
 
 import numpy as np
 from scipy import fftpack
@@ -50,6 +53,10 @@ def parse_args():
     parser.add_argument('--task_id', type=str, default='8a14a40f93e44692b3ca8b21dafdc798')
     parser.add_argument('--save_dir', type=str, default='/mnt/v1v4/grads/')
     parser.add_argument('--ckpt_dir', type=str, default='/mnt/v1v4/ckpts/')
+    parser.add_argument('--chunk_size', type=int, default=64, help='voxels per batched backward, halves on OOM')
+    parser.add_argument('--output', type=str, default='columnar', help='columnar (one ColumnStore) or npy (per video)')
+    parser.add_argument('--queue', type=str, default='',
+                        help='sqlite job queue shared by all workers, --start/--end videos are added to it')
 
     args = parser.parse_args()
     return args
@@ -183,22 +190,18 @@ num_voxels = len(voxel_config[roi])
 if args.reverse:
     idxs = idxs[::-1]
 
-for idx in idxs:
-    save_path = os.path.join(save_dir, f'video-{idx:04d}-dict.pkl.npy')
-    if os.path.exists(save_path):
-        print('skipping ...', save_path)
-        continue
-    print('saving to ...', save_path)
-
-    save_dict = {
-        'd_coeffs': torch.zeros((num_voxels, hparams['video_frames'], d_reso, d_reso), dtype=torch.float32),
-        'mods_video_before_rescale': torch.zeros((num_voxels), dtype=torch.float32),
-        'mods_video_after_rescale': torch.zeros((num_voxels), dtype=torch.float32),
-        'mods_image_before_rescale': torch.zeros((num_voxels, hparams['video_frames']), dtype=torch.float32),
-        'mods_image_after_rescale': torch.zeros((num_voxels, hparams['video_frames']), dtype=torch.float32),
-        'medians_video': torch.zeros((num_voxels), dtype=torch.float32),
-        'medians_image': torch.zeros((num_voxels, hparams['video_frames']), dtype=torch.float32),
-    }
+saliency = ChunkedInputGrads(args.chunk_size)
+summarizer = SaliencySummarizer('dct', resolution=resolution, d_reso=d_reso)
+store = ColumnStore(os.path.join(save_dir, 'saliency')) if args.output == 'columnar' else None
+
+
+def run_video(idx):
+    key = f'video-{idx:04d}'
+    save_path = os.path.join(save_dir, f'{key}-dict.pkl.npy')
+    if (key in store) if store is not None else os.path.exists(save_path):
+        print('skipping ...', key)
+        return
+    print('saving ...', key)
 
     vid = data_loader.dataset.__getitem__(idx)
     vid = torch.tensor(vid['video']).to(DEVICE).unsqueeze(0)
@@ -206,55 +209,28 @@ for idx in idxs:
     out = plmodel({'video': vid})
     out = out[0][roi][0]
 
-    for i_voxel in tqdm(range(num_voxels)):
-        #         with timeit('backward'):
-        loss = out[i_voxel] * 1e5
-        loss.backward(retain_graph=True)
-
-        grad = vid.grad.detach().clone()
-        vid.grad = None
-
-        # downsample
-        grad = F.interpolate(grad, size=(
-            grad.shape[-3], resolution, resolution))
-
-        grad = grad[0]
-        grad = grad.mean(0)  # grey
-        grad_2 = grad ** 2
-        save_dict['mods_video_before_rescale'][i_voxel] = torch.sqrt(grad_2.sum()).cpu()
-        save_dict['mods_image_before_rescale'][i_voxel] = torch.sqrt(grad_2.sum(-1).sum(-1)).cpu()
-
-        # median
-        median = grad.median()
-        save_dict['medians_video'][i_voxel] = median.cpu()
-        save_dict['medians_image'][i_voxel] = grad.reshape(hparams['video_frames'], -1).median(-1)[0].cpu()
-
-        # reject outliers
-        m = 10
-        d = torch.abs(grad - median)
-        mdev = torch.median(d)
-        mdev = mdev if mdev else 1.
-        s = d / mdev
-        mmax = median + m * mdev
-        mmin = median - m * mdev
-        grad = torch.clamp(grad, min=mmin, max=mmax)
-
-        # rescale
-        grad = 255 * (grad - mmin) / (mmax - mmin)
-
-        grad_2 = grad ** 2
-        save_dict['mods_video_after_rescale'][i_voxel] = torch.sqrt(grad_2.sum()).cpu()
-        save_dict['mods_image_after_rescale'][i_voxel] = torch.sqrt(grad_2.sum(-1).sum(-1)).cpu()
-
-        for i_frame in range(hparams['video_frames']):
-            save_dict['d_coeffs'][i_voxel][i_frame] = torch.tensor(
-                get_2d_dct(grad[i_frame].cpu().numpy())[:d_reso, :d_reso])
-
-    #         if i_voxel == 10:
-    #             break
-
-    #     with open(save_path, 'wb') as f:
-    #     break
-    np.save(save_path, save_dict)
+    # d_coeffs, mods_{video,image}_{before,after}_rescale, medians_{video,image}, one row per voxel
+    summary = saliency(out, vid, torch.arange(num_voxels), post=summarizer)
+    if store is not None:
+        store.append(key, summarizer.to_columns(summary))
+    else:
+        atomic_save_npy(save_path, {k: v.cpu() for k, v in summary.items()})
+
+
+if args.queue:
+    queue = JobQueue(args.queue)
+    queue.add(task_id, roi, idxs)
+    for job in queue.jobs(default_worker_name(DEVICE), task_id, roi, reverse=args.reverse):
+        try:
+            run_video(job.video)
+        except Exception as e:
+            print('failed ...', job, e)
+            queue.fail(job, repr(e))
+            continue
+        queue.complete(job)
+    print(queue.counts(task_id, roi))
+else:
+    for idx in idxs:
+        run_video(idx)
 
 # In[ ]: